@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+Start-up benchmark of the clan command line, which is run as thousands of
+short `clan diff` processes.
+
+Each command runs in a fresh interpreter, which reports the modules that
+clan loaded and how long the command took. The whole process is also timed
+from the outside, since interpreter start-up counts too.
+
+Usage:
+
+    python benchmarks/imports.py --max-modules 200 --max-seconds 0.5
+
+Fails if a command loads more modules or takes longer than allowed, or if
+it imports any of the network or configuration libraries it doesn't need.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+
+from clan.labels import Label
+from clan.stream import dump_report
+from clan.utils import GLOBAL_ARGUMENTS, FieldDefinitions
+
+# Libraries only `clan report` and `clan auth` need
+FORBIDDEN = ['apiclient', 'oauth2client', 'httplib2', 'yaml']
+
+# Run in the child. Modules loaded before clan is imported aren't counted.
+CHILD = '''
+import atexit, json, sys, time
+
+start = time.time()
+before = set(sys.modules)
+
+def report():
+    loaded = sorted(name for name, module in sys.modules.items() if module is not None and name not in before)
+    sys.stderr.write('\\n' + json.dumps({'seconds': time.time() - start, 'modules': loaded}) + '\\n')
+
+atexit.register(report)
+
+sys.argv = ['clan'] + json.loads(sys.argv[1])
+sys.path.insert(0, %r)
+
+import clan
+clan._main()
+''' % ROOT
+
+def _report(path, title):
+    """
+    Write a small JSON report to diff.
+    """
+    report = OrderedDict((arg, None) for arg in GLOBAL_ARGUMENTS)
+    report['title'] = title
+    report['run_date'] = '2014-01-01'
+    report['queries'] = [OrderedDict([
+        ('config', {'name': 'Pages', 'metrics': ['ga:pageviews'], 'dimensions': ['ga:pagePath']}),
+        ('sampled', False),
+        ('sampleSize', 0),
+        ('sampleSpace', 0),
+        ('data_types', OrderedDict([('ga:pageviews', 'INTEGER')])),
+        ('data', OrderedDict([('ga:pageviews', OrderedDict(
+            [(Label(['/page-%i' % i]), i * len(title)) for i in range(100)] + [('total', 4950 * len(title))]
+        ))]))
+    ])]
+
+    with open(path, 'w') as f:
+        dump_report(report, f)
+
+def measure(argv, env, repeat):
+    """
+    Run a clan command in new processes. Returns the best wall time, the best
+    time spent in clan and the modules clan loaded.
+    """
+    wall = []
+    seconds = []
+
+    for i in range(repeat):
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-c', CHILD, json.dumps(argv)], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        wall.append(time.time() - start)
+
+        if process.returncode != 0:
+            raise Exception('clan %s failed: %s' % (' '.join(argv), stderr))
+
+        result = json.loads(stderr.strip().splitlines()[-1])
+        seconds.append(result['seconds'])
+
+    return min(wall), min(seconds), result['modules']
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark how quickly clan commands start.')
+    parser.add_argument('--repeat', type=int, default=10, help='Report the best of this many runs.')
+    parser.add_argument('--max-modules', type=int, default=200, help='Fail if a command loads more modules than this.')
+    parser.add_argument('--max-seconds', type=float, default=0.5, help='Fail if a command takes longer than this, including interpreter start-up.')
+    parser.add_argument('--verbose', action='store_true', help='List the modules each command loads.')
+
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='clan-benchmark-')
+
+    try:
+        # Fresh field definitions, so they are neither fetched nor revalidated
+        FieldDefinitions(os.path.join(workdir, '.clan_defs.db')).store({
+            'ga:pageviews': {'type': 'METRIC', 'dataType': 'INTEGER', 'uiName': 'Pageviews', 'description': ''}
+        })
+
+        env = dict(os.environ, HOME=workdir)
+        report_a = os.path.join(workdir, 'a.json')
+        report_b = os.path.join(workdir, 'b.json')
+
+        _report(report_a, 'A')
+        _report(report_b, 'BB')
+
+        commands = [
+            ['--help'],
+            ['diff', '--help'],
+            ['diff', report_a, report_b, os.path.join(workdir, 'diff.json')],
+            ['diff', report_a, report_b, os.path.join(workdir, 'diff.html')]
+        ]
+
+        failures = []
+
+        print '%-28s %9s %9s %8s' % ('command', 'wall', 'clan', 'modules')
+
+        for argv in commands:
+            name = ' '.join(os.path.basename(arg) for arg in argv)
+            wall, seconds, modules = measure(argv, env, args.repeat)
+
+            print '%-28s %8.3fs %8.3fs %8i' % (name, wall, seconds, len(modules))
+
+            if args.verbose:
+                print '    ' + ' '.join(modules)
+
+            forbidden = [module for module in modules if module.split('.')[0] in FORBIDDEN]
+
+            if forbidden:
+                failures.append('%s imported %s' % (name, ', '.join(forbidden)))
+
+            if len(modules) > args.max_modules:
+                failures.append('%s loaded %i modules, more than %i' % (name, len(modules), args.max_modules))
+
+            if wall > args.max_seconds:
+                failures.append('%s took %.3f seconds, more than %.3f' % (name, wall, args.max_seconds))
+    finally:
+        shutil.rmtree(workdir)
+
+    for failure in failures:
+        print 'Failed: %s' % failure
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmark of converting a page of API results into report data.
+
+Compares ReportCommand._ingest_rows, which converts each row in a single
+pass, with the earlier approach of looping over every row once per metric,
+re-joining the label and re-dispatching on the data type for each cell.
+
+Usage:
+
+    python benchmarks/ingest.py --rows 10000 --metrics 10
+"""
+
+import argparse
+from collections import OrderedDict
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from clan.labels import LabelPool
+from clan.report import ReportCommand
+
+DATA_TYPES = ['INTEGER', 'INTEGER', 'TIME', 'PERCENT', 'FLOAT', 'CURRENCY']
+
+def response(rows, metrics, dimensions):
+    """
+    Build a synthetic API response and empty report data to ingest it into.
+    """
+    data_types = OrderedDict(('ga:metric%i' % i, DATA_TYPES[i % len(DATA_TYPES)]) for i in range(metrics))
+
+    results = [
+        ['value%i-%i' % (j, i % (10 ** (j + 1))) for j in range(dimensions)] +
+        [str(i * (j + 1)) if data_types['ga:metric%i' % j] == 'INTEGER' else '%.2f' % (i * 0.5 + j) for j in range(metrics)]
+        for i in range(rows)
+    ]
+
+    return data_types, results
+
+def _empty_data(data_types):
+    return OrderedDict([
+        ('data_types', data_types),
+        ('data', OrderedDict((metric, OrderedDict()) for metric in data_types))
+    ])
+
+def _cast_per_cell(d, dt):
+    if dt == 'INTEGER':
+        return int(d)
+    elif dt in ['TIME', 'FLOAT', 'CURRENCY', 'PERCENT']:
+        return float(d)
+    else:
+        raise Exception('Unknown metric data type: %s' % dt)
+
+def ingest_per_metric(data, dimensions_len, rows):
+    """
+    The earlier conversion, one pass over the rows per metric.
+    """
+    for i, (metric, values) in enumerate(data['data'].items()):
+        data_type = data['data_types'][metric]
+        column = i + dimensions_len
+
+        for row in rows:
+            label = ','.join(row[:dimensions_len])
+            values[label] = _cast_per_cell(row[column], data_type)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark converting API results into report data.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--metrics', type=int, default=10)
+    parser.add_argument('--dimensions', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=5, help='Report the best of this many runs.')
+
+    args = parser.parse_args()
+
+    data_types, rows = response(args.rows, args.metrics, args.dimensions)
+    command = ReportCommand()
+
+    def per_metric():
+        ingest_per_metric(_empty_data(data_types), args.dimensions, rows)
+
+    def single_pass():
+        command._ingest_rows(_empty_data(data_types), args.dimensions, rows, LabelPool())
+
+    # Both must produce the same values
+    a = _empty_data(data_types)
+    b = _empty_data(data_types)
+    ingest_per_metric(a, args.dimensions, rows)
+    command._ingest_rows(b, args.dimensions, rows, LabelPool())
+
+    for metric in data_types:
+        assert [(unicode(label), value) for label, value in b['data'][metric].items()] == a['data'][metric].items()
+
+    print '%i rows, %i metrics, %i dimensions' % (args.rows, args.metrics, args.dimensions)
+
+    baseline = min(timeit.repeat(per_metric, number=1, repeat=args.repeat))
+    print '%-12s %8.3f seconds' % ('per metric', baseline)
+
+    seconds = min(timeit.repeat(single_pass, number=1, repeat=args.repeat))
+    print '%-12s %8.3f seconds    %.2fx' % ('single pass', seconds, baseline / seconds)
+
+if __name__ == '__main__':
+    main()
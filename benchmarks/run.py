@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+"""
+End-to-end benchmarks for clan, run against a local mock of the Google
+Analytics API.
+
+Each scenario runs in a fresh process so that its peak memory can be
+measured in isolation:
+
+report       ReportCommand.report(), streamed to JSON
+diff         DiffCommand.diff() of two JSON reports, streamed to JSON
+report-html  ReportCommand.html() of a JSON report
+diff-html    DiffCommand.html() of two JSON reports
+
+Usage:
+
+    python benchmarks/run.py --sizes 1000,10000 --queries 10 --output results.json
+    python benchmarks/run.py --baseline results.json
+    python benchmarks/run.py --scenarios report --incremental
+    python benchmarks/run.py --scenarios report --unsampled --sampled-days 7
+
+With --baseline, the run fails if any scenario got slower or used more
+memory than the baseline allows.
+"""
+
+import argparse
+from collections import OrderedDict
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks import server
+
+SCENARIOS = ['report', 'diff', 'report-html', 'diff-html']
+
+class Credentials(object):
+    """
+    Stands in for OAuth credentials. The mock API doesn't check authorization.
+    """
+    invalid = False
+
+    def authorize(self, http):
+        return http
+
+def _peak_memory():
+    """
+    Peak resident memory of this process, in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, OS X bytes
+    if sys.platform == 'darwin':
+        return peak / 1024.0 / 1024.0
+
+    return peak / 1024.0
+
+def _config(queries, property_id, metrics=['ga:pageviews', 'ga:sessions', 'ga:users']):
+    return {
+        'title': 'Benchmark',
+        'property-id': property_id,
+        'start-date': '2014-01-01',
+        'end-date': '2014-01-31',
+        'paginate': True,
+        'queries': [
+            {
+                'name': 'Query %i' % i,
+                'metrics': metrics,
+                'dimensions': ['ga:pagePath'],
+                'sort': ['-ga:pageviews']
+            }
+            for i in range(queries)
+        ]
+    }
+
+def _report_command(argv):
+    from clan.report import ReportCommand
+
+    command = ReportCommand()
+
+    parser = argparse.ArgumentParser()
+    command.add_argparser(parser.add_subparsers(), [])
+
+    command.args = parser.parse_args(['report'] + argv + ['benchmark.yml', 'benchmark.json'])
+    command.field_definitions = {}
+
+    return command
+
+def _diff_command():
+    from clan.diff import DiffCommand
+
+    command = DiffCommand()
+    command.field_definitions = {}
+
+    return command
+
+def run_scenario(scenario, root, workdir, options):
+    """
+    Run one scenario in the current process. Returns its measurements.
+    """
+    from clan.stream import ReportReader, dump_report
+
+    report_a = os.path.join(workdir, 'a.json')
+    report_b = os.path.join(workdir, 'b.json')
+
+    start = time.time()
+
+    if scenario == 'report':
+        from apiclient import discovery
+
+        argv = [
+            '--threads', str(options['threads']),
+            '--batch-size', str(options['batch_size'])
+        ]
+
+        if options['unsampled']:
+            argv.append('--unsampled')
+
+        if options['incremental']:
+            argv.append('--incremental')
+        else:
+            argv.append('--no-cache')
+
+        command = _report_command(argv)
+
+        if options['incremental']:
+            from clan.cache import ResponseCache
+
+            # Days are stored in a cache of the benchmark's own
+            command.cache = ResponseCache(path=os.path.join(workdir, 'cache.db'))
+
+            # ga:users can't be added up across days
+            command.config = _config(options['queries'], options['property_id'], ['ga:pageviews', 'ga:sessions'])
+        else:
+            command.config = _config(options['queries'], options['property_id'])
+
+        command.credentials = Credentials()
+        command.service = discovery.build_from_document(json.dumps(server.discovery_document(root)), http=command._http())
+
+        report = command.report()
+
+        with open(report_a if options['property_id'] == '1' else report_b, 'w') as f:
+            dump_report(report, f)
+    elif scenario == 'diff':
+        command = _diff_command()
+
+        with open(report_a) as f_a, open(report_b) as f_b, open(os.path.join(workdir, 'diff.json'), 'w') as f:
+            dump_report(command.diff(ReportReader(f_a).report, ReportReader(f_b).report), f)
+    elif scenario == 'report-html':
+        command = _report_command([])
+
+        with open(report_a) as f_a, open(os.path.join(workdir, 'report.html'), 'w') as f:
+            command.html(ReportReader(f_a).report, f)
+    elif scenario == 'diff-html':
+        command = _diff_command()
+
+        with open(report_a) as f_a, open(report_b) as f_b, open(os.path.join(workdir, 'diff.html'), 'w') as f:
+            command.html(command.diff(ReportReader(f_a).report, ReportReader(f_b).report), f)
+    else:
+        raise Exception('Unknown scenario: %s' % scenario)
+
+    seconds = time.time() - start
+    rows = options['rows'] * options['queries']
+
+    return OrderedDict([
+        ('seconds', round(seconds, 3)),
+        ('rows_per_second', int(rows / seconds) if seconds else None),
+        ('peak_mb', round(_peak_memory(), 1))
+    ])
+
+def _child(scenario, root, workdir, options):
+    """
+    Run a scenario in a new process and return its measurements.
+    """
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__),
+        '--child', json.dumps([scenario, root, workdir, options])
+    ])
+
+    return json.loads(output.splitlines()[-1], object_pairs_hook=OrderedDict)
+
+def compare(results, baseline, tolerance):
+    """
+    List the measurements that regressed by more than ``tolerance`` (a fraction) relative to a baseline.
+    """
+    expected = dict(((r['scenario'], r['rows']), r) for r in baseline)
+    regressions = []
+
+    for result in results:
+        before = expected.get((result['scenario'], result['rows']))
+
+        if before is None:
+            continue
+
+        for measure in ['seconds', 'peak_mb']:
+            if result[measure] > before[measure] * (1 + tolerance):
+                regressions.append('%s with %i rows: %s went from %s to %s' % (
+                    result['scenario'], result['rows'], measure, before[measure], result[measure]
+                ))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark clan against a local mock of the Google Analytics API.')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma-separated numbers of rows per query.')
+    parser.add_argument('--queries', type=int, default=10, help='Number of queries per report.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated scenarios to run.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds the mock API waits before each response.')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Requests per second the mock API allows.')
+    parser.add_argument('--sampled-days', type=int, default=None, help='Date ranges longer than this are reported as sampled.')
+    parser.add_argument('--threads', type=int, default=4, help='Passed to clan report.')
+    parser.add_argument('--batch-size', type=int, default=1, help='Passed to clan report.')
+    parser.add_argument('--unsampled', action='store_true', help='Passed to clan report. Use with --sampled-days.')
+    parser.add_argument('--incremental', action='store_true', help='Passed to clan report, with a cache that starts out empty.')
+    parser.add_argument('--output', help='Write results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare results with this JSON file from an earlier run.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed fractional regression relative to the baseline.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.child:
+        print json.dumps(run_scenario(*json.loads(args.child)))
+
+        return
+
+    scenarios = args.scenarios.split(',')
+    results = []
+    workdir = tempfile.mkdtemp(prefix='clan-benchmark-')
+
+    try:
+        print '%-12s %8s %10s %12s %9s %9s' % ('scenario', 'rows', 'seconds', 'rows/sec', 'peak MB', 'requests')
+
+        for size in [int(size) for size in args.sizes.split(',')]:
+            analytics = server.MockAnalytics(rows=size, latency=args.latency, sampled_days=args.sampled_days, rate_limit=args.rate_limit)
+            httpd = server.start(analytics)
+
+            options = {
+                'rows': size,
+                'queries': args.queries,
+                'threads': args.threads,
+                'batch_size': args.batch_size,
+                'unsampled': args.unsampled,
+                'incremental': args.incremental,
+                'property_id': '1'
+            }
+
+            # Later scenarios read both reports, so they are always generated
+            for property_id in ['1', '2']:
+                requests = analytics.requests
+                result = _child('report', httpd.root, workdir, dict(options, property_id=property_id))
+                result['requests'] = analytics.requests - requests
+
+                if property_id == '1' and 'report' in scenarios:
+                    results.append(OrderedDict([('scenario', 'report'), ('rows', size)] + result.items()))
+
+            for scenario in scenarios:
+                if scenario == 'report':
+                    continue
+
+                result = _child(scenario, httpd.root, workdir, options)
+                result['requests'] = 0
+                results.append(OrderedDict([('scenario', scenario), ('rows', size)] + result.items()))
+
+            for result in results:
+                if result['rows'] == size:
+                    print '%-12s %8i %10.3f %12s %9.1f %9i' % (
+                        result['scenario'], size, result['seconds'], result['rows_per_second'], result['peak_mb'], result['requests']
+                    )
+
+            httpd.shutdown()
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print 'Regression: %s' % regression
+
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""
+A local stand-in for the Google Analytics Core Reporting API (v3).
+
+It serves the API's discovery document, the data/ga method and the batch
+endpoint. Responses are synthetic but deterministic. Their size, their
+latency, how often they are sampled and the rate limit are all configurable.
+"""
+
+import BaseHTTPServer
+from datetime import date, datetime, timedelta
+import email.parser
+import hashlib
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+
+# Google gives each API its own batch endpoint
+BATCH_PATH = 'batch/analytics/v3'
+
+def discovery_document(root):
+    """
+    Build a minimal discovery document for the Analytics API served at ``root``.
+    """
+    def param(required=False, type='string'):
+        return {'type': type, 'location': 'query', 'required': required}
+
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'analytics:v3',
+        'name': 'analytics',
+        'version': 'v3',
+        'rootUrl': root,
+        'servicePath': 'analytics/v3/',
+        'batchPath': BATCH_PATH,
+        'parameters': {
+            'alt': {'type': 'string', 'default': 'json', 'location': 'query'}
+        },
+        'schemas': {
+            'GaData': {'id': 'GaData', 'type': 'object'}
+        },
+        'resources': {'data': {'resources': {'ga': {'methods': {'get': {
+            'id': 'analytics.data.ga.get',
+            'path': 'data/ga',
+            'httpMethod': 'GET',
+            'parameters': {
+                'ids': param(True),
+                'start-date': param(True),
+                'end-date': param(True),
+                'metrics': param(True),
+                'dimensions': param(),
+                'filters': param(),
+                'segment': param(),
+                'sort': param(),
+                'start-index': param(type='integer'),
+                'max-results': param(type='integer')
+            },
+            'parameterOrder': ['ids', 'start-date', 'end-date', 'metrics'],
+            'response': {'$ref': 'GaData'}
+        }}}}}}
+    }
+
+class MockAnalytics(object):
+    """
+    Configuration and request counters for a mock API server.
+
+    ``rows`` is the number of results every dimensioned query has. Each
+    request waits ``latency`` seconds. Queries covering more than
+    ``sampled_days`` days are reported as sampled. If ``rate_limit`` is set,
+    requests beyond that many per second fail with userRateLimitExceeded.
+    """
+    def __init__(self, rows=1000, latency=0.0, sampled_days=None, rate_limit=None):
+        self.rows = rows
+        self.latency = latency
+        self.sampled_days = sampled_days
+        self.rate_limit = rate_limit
+        self.window = None
+        self.window_requests = 0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.rate_limited = 0
+
+    def _count(self, **counts):
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def _allowed(self):
+        """
+        Count a request against the rate limit, which resets every second.
+        Returns False if the limit has been reached.
+        """
+        if not self.rate_limit:
+            return True
+
+        with self.lock:
+            window = int(time.time())
+
+            if window != self.window:
+                self.window = window
+                self.window_requests = 0
+
+            if self.window_requests >= self.rate_limit:
+                return False
+
+            self.window_requests += 1
+
+            return True
+
+    def query(self, query):
+        """
+        Answer a data/ga query. Returns an HTTP status and a JSON-serializable body.
+        """
+        self._count(requests=1)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not self._allowed():
+            self._count(rate_limited=1)
+
+            return 403, {'error': {'code': 403, 'message': 'User Rate Limit Exceeded', 'errors': [
+                {'domain': 'usageLimits', 'reason': 'userRateLimitExceeded', 'message': 'User Rate Limit Exceeded'}
+            ]}}
+
+        return 200, self.results(query)
+
+    def results(self, query):
+        """
+        Generate a page of deterministic results for a query.
+        """
+        metrics = query['metrics'].split(',')
+        dimensions = query['dimensions'].split(',') if query.get('dimensions') else []
+        start_index = int(query.get('start-index', 1))
+        max_results = int(query.get('max-results', 1000))
+
+        # Different properties and date ranges get different, but repeatable, values
+        seed = int(hashlib.md5('%s %s %s' % (query['ids'], query['start-date'], query['end-date'])).hexdigest()[:6], 16)
+
+        def value(row, column):
+            return (seed + row * 7919 + column * 104729) % 100000
+
+        days = self._dates(query)
+
+        # Broken down by date alone there is one row per day
+        total_results = len(days) if dimensions == ['ga:date'] else self.rows if dimensions else 1
+
+        def dimension_value(dimension, row):
+            # Rows cycle through the days, so each combination is unique
+            if dimension == 'ga:date':
+                return days[row % len(days)].strftime('%Y%m%d')
+            elif 'ga:date' in dimensions:
+                row = row // len(days)
+
+            return '%s-%i' % (dimension.split(':')[-1], row)
+
+        rows = [
+            [dimension_value(dimension, i) for dimension in dimensions] + [str(value(i, j)) for j in range(len(metrics))]
+            for i in range(start_index - 1, min(total_results, start_index - 1 + max_results))
+        ]
+
+        results = {
+            'kind': 'analytics#gaData',
+            'columnHeaders': [{'name': dimension, 'columnType': 'DIMENSION', 'dataType': 'STRING'} for dimension in dimensions] +
+                [{'name': metric, 'columnType': 'METRIC', 'dataType': 'INTEGER'} for metric in metrics],
+            'totalResults': total_results,
+            'totalsForAllResults': dict((metric, str(sum(value(i, j) for i in range(total_results)))) for j, metric in enumerate(metrics)),
+            'containsSampledData': False
+        }
+
+        if dimensions:
+            results['rows'] = rows
+
+        if self.sampled_days and self._days(query) > self.sampled_days:
+            results['containsSampledData'] = True
+            results['sampleSize'] = str(self.sampled_days * 1000)
+            results['sampleSpace'] = str(self._days(query) * 1000)
+
+        return results
+
+    def _dates(self, query):
+        """
+        List the days a query covers.
+        """
+        try:
+            start = datetime.strptime(query['start-date'], '%Y-%m-%d').date()
+            end = datetime.strptime(query['end-date'], '%Y-%m-%d').date()
+        except ValueError:
+            # Relative dates, such as 30daysAgo, are treated as a single day
+            return [date.today()]
+
+        return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+    def _days(self, query):
+        return len(self._dates(query))
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _query(self, path):
+        url = urlparse.urlparse(path)
+
+        return dict((key, values[0]) for key, values in urlparse.parse_qs(url.query).items())
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/discovery'):
+            body = json.dumps(discovery_document(self.server.root))
+            self._send(200, 'application/json', body)
+        else:
+            status, results = self.server.analytics.query(self._query(self.path))
+            self._send(status, 'application/json', json.dumps(results))
+
+    def do_POST(self):
+        # Only the path the discovery document gives accepts batches
+        if self.path != '/' + BATCH_PATH:
+            self._send(404, 'text/plain', 'Not found')
+
+            return
+
+        self.server.analytics._count(batches=1)
+
+        content = self.rfile.read(int(self.headers['Content-Length']))
+
+        parser = email.parser.FeedParser()
+        parser.feed('Content-Type: %s\r\n\r\n' % self.headers['Content-Type'])
+        parser.feed(content)
+
+        parts = []
+
+        for part in parser.close().get_payload():
+            request_line = part.get_payload().split('\n', 1)[0].split(' ')
+            status, results = self.server.analytics.query(self._query(request_line[1]))
+
+            parts.append(
+                '--batch\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                'HTTP/1.1 %i %s\r\nContent-Type: application/json\r\n\r\n%s\r\n' % (
+                    part['Content-ID'].strip('<>'), status, self.responses[status][0], json.dumps(results)
+                )
+            )
+
+        self._send(200, 'multipart/mixed; boundary=batch', ''.join(parts) + '--batch--\r\n')
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def start(analytics):
+    """
+    Serve a MockAnalytics instance on a free local port, in a background
+    thread. Returns the server, whose ``root`` is the base URL of the API.
+    """
+    server = Server(('127.0.0.1', 0), Handler)
+    server.analytics = analytics
+    server.root = 'http://127.0.0.1:%i/' % server.server_address[1]
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
@@ -1,16 +1,16 @@
 #!/usr/bin/env python
 
 import argparse
+from importlib import import_module
 import sys 
 
-from clan.auth import AuthCommand
-from clan.diff import DiffCommand
-from clan.report import ReportCommand
-
+# Commands are imported only when they are run, so that their dependencies
+# don't slow down every invocation: (name, module, class, help)
 COMMANDS = [
-    AuthCommand,
-    ReportCommand,
-    DiffCommand
+    ('auth', 'clan.auth', 'AuthCommand', 'Authorize clan to access your Google Analytics data.'),
+    ('report', 'clan.report', 'ReportCommand', 'Query Google Analytics and generate a report.'),
+    ('diff', 'clan.diff', 'DiffCommand', 'Compare two or more reports.'),
+    ('render', 'clan.render', 'RenderCommand', 'Render archived reports and diffs as HTML.')
 ]
 
 class Clan(object):
@@ -38,14 +38,29 @@ class Clan(object):
 
         # Command parsers
         subparsers = self.argparser.add_subparsers()
+        requested = self._requested_command()
 
-        for cls in COMMANDS:
-            command = cls()
-            command.add_argparser(subparsers, [generic_parser])
+        for name, module, cls_name, help in COMMANDS:
+            if name == requested:
+                command = getattr(import_module(module), cls_name)()
+                command.add_argparser(subparsers, [generic_parser])
+            else:
+                # Enough for usage messages, without importing the command
+                subparsers.add_parser(name, help=help)
 
         self.args = self.argparser.parse_args()
         self.args.func(self.args)
 
+    def _requested_command(self):
+        """
+        Find the name of the command being run, if any.
+        """
+        for arg in sys.argv[1:]:
+            if not arg.startswith('-'):
+                return arg
+
+        return None
+
     def _install_exception_handler(self):
         """
         Installs a replacement for sys.excepthook, which handles pretty-printing uncaught exceptions.
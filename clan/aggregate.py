@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+from array import array
+from collections import OrderedDict
+import re
+
+from clan.labels import Label, LabelPool
+from clan.merge import DERIVED_METRICS, _ratio, is_additive
+
+FILTER_PATTERN = re.compile(r'^(ga:\w+)(==|!=|=@|!@|=~|!~|>=|<=|>|<)(.*)$')
+
+def _unescape(value):
+    return value.replace('\\,', ',').replace('\\;', ';')
+
+def _clause(expression, dimensions, columns):
+    """
+    Compile one filter expression, such as ``ga:country==Canada`` or
+    ``ga:pageviews>100``, to a test of a row index and its dimension values.
+    """
+    match = FILTER_PATTERN.match(expression)
+
+    if not match:
+        raise Exception('Invalid view filter: %s' % expression)
+
+    field, operator, operand = match.groups()
+    operand = _unescape(operand)
+
+    if field in dimensions:
+        position = dimensions.index(field)
+
+        if operator == '==':
+            return lambda i, parts: parts[position] == operand
+        elif operator == '!=':
+            return lambda i, parts: parts[position] != operand
+        elif operator == '=@':
+            return lambda i, parts: operand in parts[position]
+        elif operator == '!@':
+            return lambda i, parts: operand not in parts[position]
+        elif operator == '=~':
+            regex = re.compile(operand)
+            return lambda i, parts: regex.search(parts[position]) is not None
+        elif operator == '!~':
+            regex = re.compile(operand)
+            return lambda i, parts: regex.search(parts[position]) is None
+    elif field in columns:
+        column = columns[field]
+        operand = float(operand)
+
+        if operator == '==':
+            return lambda i, parts: column[i] == operand
+        elif operator == '!=':
+            return lambda i, parts: column[i] != operand
+        elif operator == '>':
+            return lambda i, parts: column[i] > operand
+        elif operator == '<':
+            return lambda i, parts: column[i] < operand
+        elif operator == '>=':
+            return lambda i, parts: column[i] >= operand
+        elif operator == '<=':
+            return lambda i, parts: column[i] <= operand
+    else:
+        raise Exception('View filter on %s, which is not among the query\'s dimensions or metrics.' % field)
+
+    raise Exception('Operator %s can\'t be used with %s in a view filter.' % (operator, field))
+
+def compile_filter(expression, dimensions, columns):
+    """
+    Compile a Google Analytics filter expression to a test of a row index and
+    its dimension values. As in Google Analytics, ``;`` separates clauses that
+    must all match and ``,`` alternatives of which any may match.
+    """
+    clauses = [
+        [_clause(alternative, dimensions, columns) for alternative in re.split(r'(?<!\\),', clause)]
+        for clause in re.split(r'(?<!\\);', expression)
+    ]
+
+    return lambda i, parts: all(any(test(i, parts) for test in alternatives) for alternatives in clauses)
+
+def aggregate(query, view):
+    """
+    Derive a view of a query's data locally, without querying Google again.
+
+    A view may re-group rows by some of the query's dimensions, filter them,
+    sort them and keep only the top ``max-results``, optionally rolling the
+    rest up into a row labeled by ``other``. Returns data in the same format
+    as a query's.
+    """
+    config = query['config']
+    dimensions = config.get('dimensions', [])
+    group = view.get('dimensions', [])
+    name = view.get('name', '%s by %s' % (config['name'], ', '.join(group) or 'total'))
+
+    for dimension in group:
+        if dimension not in dimensions:
+            raise Exception('View "%s" groups by %s, which query "%s" doesn\'t include.' % (name, dimension, config['name']))
+
+    positions = [dimensions.index(dimension) for dimension in group]
+
+    # Combining rows is only exact for metrics that add up, or can be recomputed from ones that do
+    combines = positions != range(len(dimensions)) or view.get('filter') or view.get('other')
+
+    def mergeable(metric):
+        if is_additive(metric, query['data_types'][metric]):
+            return True
+
+        return metric in DERIVED_METRICS and all(
+            component in query['data'] and is_additive(component, query['data_types'][component])
+            for component in DERIVED_METRICS[metric][:2]
+        )
+
+    if 'metrics' in view:
+        metrics = view['metrics']
+
+        for metric in metrics:
+            if metric not in query['data']:
+                raise Exception('View "%s" reports %s, which query "%s" doesn\'t include.' % (name, metric, config['name']))
+
+            if combines and not mergeable(metric):
+                raise Exception('View "%s" combines rows, but %s can\'t be added up.' % (name, metric))
+    else:
+        metrics = [metric for metric in config['metrics'] if not combines or mergeable(metric)]
+
+    derived = [metric for metric in metrics if combines and metric in DERIVED_METRICS]
+    summed = [metric for metric in metrics if metric not in derived]
+
+    for metric in derived:
+        for component in DERIVED_METRICS[metric][:2]:
+            if component not in summed:
+                summed.append(component)
+
+    # Load the query's rows into one array per metric
+    labels = [label for label in query['data'][config['metrics'][0]] if label != 'total']
+    columns = OrderedDict(
+        (metric, array('d', [query['data'][metric].get(label, 0) for label in labels]))
+        for metric in config['metrics']
+    )
+
+    keep = compile_filter(view['filter'], dimensions, columns) if view.get('filter') else None
+
+    # Hash aggregation: each distinct group gets an index into the arrays of sums
+    groups = {}
+    keys = []
+    sums = [array('d') for metric in summed]
+    sources = [columns[metric] for metric in summed]
+    pool = LabelPool()
+
+    for i, label in enumerate(labels):
+        if keep is not None and not keep(i, label):
+            continue
+
+        key = tuple([label[position] for position in positions])
+        g = groups.get(key)
+
+        if g is None:
+            g = groups[key] = len(keys)
+            keys.append(pool.label(key))
+
+            for column in sums:
+                column.append(0)
+
+        for column, source in zip(sums, sources):
+            column[g] += source[i]
+
+    results = OrderedDict(zip(summed, sums))
+
+    for metric in derived:
+        numerator, denominator, scale = DERIVED_METRICS[metric]
+        results[metric] = array('d', [
+            _ratio(n, d, scale) for n, d in zip(results[numerator], results[denominator])
+        ])
+
+    # Rows keep the query's order unless the view sorts them
+    order = range(len(keys))
+
+    for field in reversed(view.get('sort', [])):
+        field_name = field.lstrip('-')
+
+        if field_name in results:
+            column = results[field_name]
+            order.sort(key=lambda g: column[g], reverse=field.startswith('-'))
+        elif field_name in group:
+            position = group.index(field_name)
+            order.sort(key=lambda g: keys[g][position], reverse=field.startswith('-'))
+        else:
+            raise Exception('View "%s" sorts by %s, which it doesn\'t include.' % (name, field_name))
+
+    rest = []
+
+    if view.get('max-results') is not None:
+        rest = order[view['max-results']:]
+        order = order[:view['max-results']]
+
+    data = OrderedDict([
+        ('config', OrderedDict([('name', name)] + [(key, value) for key, value in view.items() if key != 'name'])),
+        ('sampled', query['sampled']),
+        ('sampleSize', query['sampleSize']),
+        ('sampleSpace', query['sampleSpace']),
+        ('data_types', OrderedDict((metric, query['data_types'][metric]) for metric in metrics)),
+        ('data', OrderedDict())
+    ])
+
+    data['config']['metrics'] = metrics
+    data['config']['dimensions'] = group
+    data['config']['view-of'] = config['name']
+
+    def cast(metric, value):
+        if data['data_types'][metric] == 'INTEGER':
+            return int(round(value))
+
+        return value
+
+    def total(metric, indexes):
+        if metric in derived:
+            numerator, denominator, scale = DERIVED_METRICS[metric]
+            return _ratio(total(numerator, indexes), total(denominator, indexes), scale)
+
+        return sum(results[metric][g] for g in indexes)
+
+    for metric in metrics:
+        values = data['data'][metric] = OrderedDict()
+
+        if group:
+            for g in order:
+                values[keys[g]] = cast(metric, results[metric][g])
+
+            if rest and view.get('other'):
+                values[Label([view['other']])] = cast(metric, total(metric, rest))
+
+        # Unfiltered views cover the same rows as the query, so its exact totals still apply
+        if view.get('filter'):
+            values['total'] = cast(metric, total(metric, range(len(keys))))
+        else:
+            values['total'] = query['data'][metric]['total']
+
+    return data
@@ -2,15 +2,15 @@
 
 import os
 
-from oauth2client import client
-from oauth2client.file import Storage
-from oauth2client import tools
-
 class AuthCommand(object):
     def __init__(self):
         self.args = None
 
     def __call__(self, args):
+        from oauth2client import client
+        from oauth2client.file import Storage
+        from oauth2client import tools
+
         self.args = args 
 
         if not self.args.secrets:
@@ -36,6 +36,8 @@ class AuthCommand(object):
         """
         Add arguments for this command.
         """
+        from oauth2client import tools
+
         parents.append(tools.argparser)
 
         parser = root.add_parser('auth', parents=parents)
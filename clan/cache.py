@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+CACHE_PATH = os.path.expanduser('~/.clan_cache.db')
+
+class ResponseCache(object):
+    """
+    SQLite-backed cache of API responses, keyed by normalized query parameters.
+
+    Entries without an expiration are kept until they are evicted. When the
+    cache grows past ``max_size`` bytes, expired entries are deleted, then the
+    least recently used entries.
+
+    The size of the cache is kept as a running total, so it is only summed
+    again when an insert may have pushed it past ``max_size``.
+    """
+    def __init__(self, path=CACHE_PATH, max_size=100 * 1024 * 1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self.db:
+            self.db.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response BLOB,
+                    size INTEGER,
+                    expires REAL,
+                    accessed REAL
+                )
+            ''')
+
+            self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+        self.size = self._total()
+
+    def key(self, params):
+        """
+        Compute a stable cache key for a dictionary of query parameters.
+        """
+        return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        """
+        Fetch a cached response, or None if it is missing or expired.
+        """
+        now = time.time()
+
+        with self.lock, self.db:
+            row = self.db.execute('SELECT response, size, expires FROM responses WHERE key = ?', (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            response, size, expires = row
+
+            if expires is not None and expires < now:
+                self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.size -= size
+
+                return None
+
+            self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+
+        return json.loads(zlib.decompress(response))
+
+    def set(self, key, response, ttl=None):
+        """
+        Store a response. If ``ttl`` is None the entry never expires.
+        """
+        now = time.time()
+        blob = sqlite3.Binary(zlib.compress(json.dumps(response)))
+        expires = now + ttl if ttl is not None else None
+
+        with self.lock, self.db:
+            row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses (key, response, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, blob, len(blob), expires, now)
+            )
+
+            self.size += len(blob) - (row[0] if row is not None else 0)
+
+            if self.size > self.max_size:
+                self._evict()
+
+    def _total(self):
+        """
+        Sum the size of every entry.
+        """
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _evict(self):
+        """
+        Delete expired entries, then least recently used entries until the cache fits in max_size.
+        """
+        self.db.execute('DELETE FROM responses WHERE expires < ?', (time.time(),))
+
+        # Other processes may share the cache, so the running total is only an estimate
+        self.size = self._total()
+
+        if self.size <= self.max_size:
+            return
+
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.size -= size
+
+            if self.size <= self.max_size:
+                break
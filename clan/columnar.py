@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+from collections import Mapping, OrderedDict
+from itertools import izip
+import json
+import mmap
+import struct
+
+from clan.labels import LabelPool, encode_label
+
+MAGIC = 'CLAN\x01\x00\x00\x00'
+
+# Struct formats used to store each metric data type
+COLUMN_TYPES = {
+    'INTEGER': 'q',
+    'FLOAT': 'd',
+    'TIME': 'd',
+    'PERCENT': 'd',
+    'CURRENCY': 'd'
+}
+
+LABEL_TYPE = 'i'
+OFFSET_TYPE = 'q'
+
+class ColumnarWriter(object):
+    """
+    Write reports in clan's columnar binary format.
+
+    The file begins with a magic number, followed by one column of label
+    indexes per query and one typed column of values per metric. A shared
+    dictionary of label strings comes next, then a JSON footer that records
+    the report metadata and where every column begins. The footer's length
+    and the magic number end the file. All numbers are little-endian and every
+    column is 8-byte aligned. Labels are stored encoded as strings.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.offset = 0
+        self.strings = OrderedDict()
+
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self.f.write(data)
+        self.offset += len(data)
+
+    def _column(self, fmt, values):
+        """
+        Write a column of values and return its location.
+        """
+        padding = -self.offset % 8
+        self._write('\x00' * padding)
+
+        location = [self.offset, len(values)]
+
+        # Write in slices so huge columns aren't packed into one giant string
+        for i in range(0, len(values), 65536):
+            chunk = values[i:i + 65536]
+            self._write(struct.pack('<%i%s' % (len(chunk), fmt), *chunk))
+
+        return location
+
+    def _intern(self, label):
+        index = self.strings.get(label)
+
+        if index is None:
+            index = self.strings[label] = len(self.strings)
+
+        return index
+
+    def write_query(self, query):
+        """
+        Write the columns for one query and return its footer metadata.
+        """
+        meta = OrderedDict((key, value) for key, value in query.items() if key != 'data')
+        meta['data'] = OrderedDict()
+
+        shared_labels = None
+        shared_location = None
+
+        for metric, values in query['data'].items():
+            fmt = COLUMN_TYPES[query['data_types'][metric]]
+            labels = [label for label in values.keys() if label != 'total']
+
+            # Every metric in a report normally has the same labels, so they're stored once per query
+            if labels != shared_labels:
+                shared_labels = labels
+                shared_location = self._column(LABEL_TYPE, [self._intern(label) for label in labels])
+
+            meta['data'][metric] = OrderedDict([
+                ('labels', shared_location),
+                ('values', self._column(fmt, [values[label] for label in labels])),
+                ('type', fmt),
+                ('total', values.get('total'))
+            ])
+
+        return meta
+
+    def close(self, report, queries_meta):
+        """
+        Write the string dictionary and footer.
+        """
+        encoded = [encode_label(label).encode('utf-8') for label in self.strings]
+
+        offsets = [0]
+
+        for s in encoded:
+            offsets.append(offsets[-1] + len(s))
+
+        footer = OrderedDict((key, value) for key, value in report.items() if key != 'queries')
+        footer['strings'] = self._column(OFFSET_TYPE, offsets)
+        footer['strings'].append(self.offset)
+
+        self._write(''.join(encoded))
+
+        footer['queries'] = queries_meta
+
+        data = json.dumps(footer)
+        self._write(data)
+        self._write(struct.pack('<Q', len(data)))
+        self._write(MAGIC)
+
+def dump_columnar(report, f):
+    """
+    Write a report in columnar format. ``report['queries']`` may be a generator.
+    """
+    writer = ColumnarWriter(f)
+    queries_meta = [writer.write_query(query) for query in report['queries']]
+
+    writer.close(report, queries_meta)
+
+class Column(object):
+    """
+    Read-only view of a typed column in a memory-mapped file. Values are
+    unpacked on access rather than parsed up front.
+    """
+    def __init__(self, buf, location, fmt):
+        self.buf = buf
+        self.offset, self.count = location[:2]
+        self.fmt = '<' + fmt
+        self.size = struct.calcsize(self.fmt)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+
+        return struct.unpack_from(self.fmt, self.buf, self.offset + i * self.size)[0]
+
+    def __iter__(self):
+        for i in range(0, self.count, 65536):
+            n = min(65536, self.count - i)
+
+            for value in struct.unpack_from('<%i%s' % (n, self.fmt[1:]), self.buf, self.offset + i * self.size):
+                yield value
+
+class StringTable(object):
+    """
+    Lazily-decoded dictionary of labels.
+    """
+    def __init__(self, buf, location):
+        self.buf = buf
+        self.offsets = Column(buf, location, OFFSET_TYPE)
+        self.base = location[2]
+        self.cache = {}
+        self.pool = LabelPool()
+
+    def __getitem__(self, i):
+        s = self.cache.get(i)
+
+        if s is None:
+            start = self.base + self.offsets[i]
+            end = self.base + self.offsets[i + 1]
+            s = self.cache[i] = self.pool.decode(self.buf[start:end].decode('utf-8'))
+
+        return s
+
+class MetricView(Mapping):
+    """
+    Read-only mapping of labels to values for one metric, backed by columns
+    in a memory-mapped file. Like the per-metric dictionaries of a JSON report,
+    it ends with the 'total' label.
+    """
+    def __init__(self, strings, labels, column, total):
+        self.strings = strings
+        self.labels = labels
+        self.column = column
+        self.total = total
+        self._index = None
+
+    def __len__(self):
+        return len(self.labels) + 1
+
+    def __iter__(self):
+        for i in self.labels:
+            yield self.strings[i]
+
+        yield 'total'
+
+    def __getitem__(self, label):
+        if label == 'total':
+            return self.total
+
+        if self._index is None:
+            self._index = dict((self.strings[i], position) for position, i in enumerate(self.labels))
+
+        return self.column[self._index[label]]
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for i, value in izip(self.labels, self.column):
+            yield self.strings[i], value
+
+        yield 'total', self.total
+
+    def items(self):
+        return list(self.iteritems())
+
+def load_columnar(f):
+    """
+    Open a report in columnar format. Returns a report with the same structure
+    as one loaded from JSON, whose metric data is read from a memory map on
+    demand.
+    """
+    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buf[:len(MAGIC)] != MAGIC or buf[-len(MAGIC):] != MAGIC:
+        raise Exception('Not a clan columnar report: %s' % f.name)
+
+    footer_end = len(buf) - len(MAGIC) - 8
+    footer_len = struct.unpack_from('<Q', buf, footer_end)[0]
+    footer = json.loads(buf[footer_end - footer_len:footer_end], object_pairs_hook=OrderedDict)
+
+    strings = StringTable(buf, footer.pop('strings'))
+    report = footer
+
+    for query in report['queries']:
+        for metric, meta in query['data'].items():
+            query['data'][metric] = MetricView(
+                strings,
+                Column(buf, meta['labels'], LABEL_TYPE),
+                Column(buf, meta['values'], meta['type']),
+                meta['total']
+            )
+
+    return report
@@ -1,12 +1,152 @@
 #!/usr/bin/env python
 
-from collections import OrderedDict
-import json
+from collections import OrderedDict, defaultdict, deque
+import gc
+from itertools import izip
 import os
+import re
+
+from clan.columnar import load_columnar
+from clan.stream import ReportReader, dump_report
+from clan.templates import get_environment, render_to_file
+from clan.utils import GLOBAL_ARGUMENTS, atomic_write, config_hash, format_comma, format_duration, format_percent, load_field_definitions
+
+def diff_values(values_a, values_b, data_type):
+    """
+    Compute the change, percent change and percentage point change of one
+    metric for every label in both A and B, in a single pass over A. Returns
+    the changes for each label and the labels found only in A and only in B.
+    """
+    total_a = values_a['total']
+    total_b = values_b['total']
+
+    points = data_type != 'TIME' and total_a > 0 and total_b > 0
+    total_a = float(total_a)
+    total_b = float(total_b)
+
+    get_b = values_b.get
+    changes = OrderedDict()
+    only_a = []
+
+    for label, a in values_a.iteritems():
+        b = get_b(label)
+
+        if b is None:
+            only_a.append(label)
+            continue
+
+        change = b - a
+
+        # Assigning keys one at a time is much cheaper than passing OrderedDict a list
+        values = changes[label] = OrderedDict()
+        values['change'] = change
+        values['percent_change'] = float(change) / a if a > 0 else None
+        values['point_change'] = b / total_b - a / total_a if points and label != 'total' else None
+
+    # Every label of B was matched unless B has more than were found
+    if len(changes) < len(values_b):
+        only_b = [label for label in values_b if label not in values_a]
+    else:
+        only_b = []
+
+    return changes, only_a, only_b
+
+def align_series_labels(metrics):
+    """
+    Outer-join the labels of one metric across several reports. ``metrics``
+    holds the metric's values from each report, or None where a report lacks
+    the query. Returns every label in order of first appearance, followed by
+    'total'.
+    """
+    labels = []
+    seen = set()
+
+    for values in metrics:
+        if values is None:
+            continue
+
+        for label in values:
+            if label != 'total' and label not in seen:
+                seen.add(label)
+                labels.append(label)
+
+    return labels + ['total']
+
+def compute_series(columns, window):
+    """
+    Compute period-over-period changes, percent changes and rolling means for
+    aligned columns of values, one column per report. Missing values are
+    None. Rolling means cover up to ``window`` reports, ending with each one.
+    Returns a list of columns for each measure.
+    """
+    size = len(columns[0])
+
+    changes = [[None] * size]
+    percent_changes = [[None] * size]
+
+    for column_a, column_b in izip(columns, columns[1:]):
+        change = [b - a if a is not None and b is not None else None for a, b in izip(column_a, column_b)]
+
+        changes.append(change)
+        percent_changes.append([float(c) / a if c is not None and a > 0 else None for c, a in izip(change, column_a)])
+
+    # Running sums and counts, from which each report's rolling mean follows
+    sums = [0] * size
+    counts = [0] * size
+    rolling_means = []
+
+    for i, column in enumerate(columns):
+        sums = [total + value if value is not None else total for total, value in izip(sums, column)]
+        counts = [count + 1 if value is not None else count for count, value in izip(counts, column)]
+
+        if i >= window:
+            expired = columns[i - window]
+            sums = [total - value if value is not None else total for total, value in izip(sums, expired)]
+            counts = [count - 1 if value is not None else count for count, value in izip(counts, expired)]
+
+        rolling_means.append([float(total) / count if count else None for total, count in izip(sums, counts)])
+
+    return changes, percent_changes, rolling_means
+
+def number_class(v):
+    """
+    CSS class for a positive or negative change.
+    """
+    if v is None:
+        return ''
+
+    if v > 0:
+        return 'positive'
+    elif v < 0:
+        return 'negative'
 
-from jinja2 import Environment, PackageLoader
+    return ''
 
-from clan.utils import GLOBAL_ARGUMENTS, format_comma, format_duration, format_percent, load_field_definitions
+def sparkline(values, width=100, height=20):
+    """
+    Plot a series as the points of an SVG polyline. Missing values are skipped.
+    """
+    present = [(i, value) for i, value in enumerate(values) if value is not None]
+
+    if len(present) < 2:
+        return ''
+
+    low = min(value for i, value in present)
+    span = float(max(value for i, value in present) - low) or 1.0
+    step = float(width) / (len(values) - 1)
+
+    return ' '.join('%.1f,%.1f' % (i * step, height - (value - low) / span * height) for i, value in present)
+
+def _summarize(values):
+    """
+    The mean, minimum and maximum of a series, ignoring missing values.
+    """
+    present = [value for value in values if value is not None]
+
+    if not present:
+        return [('mean', None), ('min', None), ('max', None)]
+
+    return [('mean', float(sum(present)) / len(present)), ('min', min(present)), ('max', max(present))]
 
 class DiffCommand(object):
     def __init__(self):
@@ -14,29 +154,57 @@ class DiffCommand(object):
     
     def __call__(self, args):
         """
-        Compare two data files and generate a report of their differences.
+        Compare two data files and generate a report of their differences, or
+        several and generate a time series.
         """
         self.args = args
         self.field_definitions = load_field_definitions()
 
-        with open(self.args.report_a_path) as f:
-            report_a = json.load(f, object_pairs_hook=OrderedDict)
-
-        with open(self.args.report_b_path) as f:
-            report_b = json.load(f, object_pairs_hook=OrderedDict)
-
-        diff = self.diff(report_a, report_b)
-
-        output_format = os.path.splitext(self.args.output_path)[1]
+        if len(self.args.report_paths) < 2:
+            raise Exception('At least two reports are needed to compare.')
+
+        # Reports are read incrementally, so only the queries being compared
+        # need to be held in memory
+        files = [open(path, 'rb') for path in self.args.report_paths]
+
+        try:
+            reports = [self._load(f) for f in files]
+
+            if len(reports) == 2:
+                diff = self.diff(*reports)
+                html = self.html
+            else:
+                diff = self.series(reports, self.args.window)
+                html = self.series_html
+
+            output_format = os.path.splitext(self.args.output_path)[1]
+
+            # The diff is computed as it is written, so a failure mustn't
+            # leave a partial copy in place of the previous one
+            if output_format == '.html':
+                with atomic_write(self.args.output_path) as f:
+                    html(diff, f)
+            elif output_format == '.json':
+                with atomic_write(self.args.output_path) as f:
+                    dump_report(diff, f)
+            else:
+                raise Exception('Unsupported output format: %s. Must be .html or .json.' % output_format) 
+        finally:
+            for f in files:
+                f.close()
+
+    def _load(self, f):
+        """
+        Open a JSON or columnar report for reading.
+        """
+        input_format = os.path.splitext(f.name)[1]
 
-        if output_format == '.html':
-            with open(self.args.output_path, 'w') as f:
-                self.html(diff, f)
-        elif output_format == '.json':
-            with open(self.args.output_path, 'w') as f:
-                json.dump(diff, f, indent=4)
+        if input_format == '.clan':
+            return load_columnar(f)
+        elif input_format == '.json':
+            return ReportReader(f).report
         else:
-            raise Exception('Unsupported output format: %s. Must be .html or .json.' % output_format) 
+            raise Exception('Unsupported input format: %s. Must be .json or .clan.' % input_format)
 
     def add_argparser(self, root, parents):
         """
@@ -58,15 +226,15 @@ class DiffCommand(object):
         )
 
         parser.add_argument(
-           'report_a_path',
-            action='store',
-            help='Path to a JSON file containing the initial report data.'
+            '--window',
+            dest='window', action='store', type=int, default=4,
+            help='Number of reports averaged by rolling means when comparing more than two reports.'
         )
 
         parser.add_argument(
-           'report_b_path',
-            action='store',
-            help='Path to a JSON file containing the report data to compare.'
+           'report_paths',
+            action='store', nargs='+',
+            help='Paths to JSON or columnar (.clan) files containing report data, oldest first. Two reports are diffed. More are compared as a time series.'
         )
 
         parser.add_argument(
@@ -80,74 +248,202 @@ class DiffCommand(object):
     def diff(self, report_a, report_b):
         """
         Generate a diff for two data reports.
+
+        ``report_b['queries']`` must support indexing as well as iteration.
+        The diff's queries are generated lazily; its list of unmatched queries
+        is complete once they have been consumed.
         """
         arguments = GLOBAL_ARGUMENTS + ['run_date']
 
         output = OrderedDict([
             ('a', OrderedDict([(arg, report_a[arg]) for arg in arguments])),
             ('b', OrderedDict([(arg, report_b[arg]) for arg in arguments])),
-            ('queries', [])
+            ('queries', None),
+            ('unmatched', OrderedDict([('a', []), ('b', [])]))
         ])
 
-        output['a']
+        output['queries'] = self._diff_queries(report_a, report_b, output['unmatched'])
+
+        return output
+
+    def _diff_queries(self, report_a, report_b, unmatched):
+        """
+        Yield a diff for each pair of matching queries.
+        """
+        # Index B once by position so each query in A can be matched in
+        # constant time. Repeated configs are paired off in the order they
+        # occur. Configs are kept so unmatched queries needn't be read again.
+        index = defaultdict(deque)
+        configs_b = []
+        matched = set()
+
+        for i, query_b in enumerate(report_b['queries']):
+            index[config_hash(query_b['config'])].append(i)
+            configs_b.append(query_b['config'])
 
         for query_a in report_a['queries']:
-            for query_b in report_b['queries']:
-                if query_a['config'] == query_b['config']:
-                    diff = OrderedDict()
+            matches = index[config_hash(query_a['config'])]
+
+            if not matches:
+                unmatched['a'].append(query_a['config'])
+                continue
+
+            i = matches.popleft()
+            matched.add(i)
+            query_b = report_b['queries'][i]
+
+            diff = OrderedDict()
+
+            diff['config'] = query_a['config']
+            diff['data_types'] = query_a['data_types']
+            diff['data'] = OrderedDict()
+
+            diff['unmatched'] = OrderedDict([('a', []), ('b', [])])
+
+            for metric, values_a in query_a['data'].items():
+                # Each OrderedDict is a reference cycle, so building hundreds of
+                # thousands of them would otherwise set off repeated full
+                # garbage collections
+                enabled = gc.isenabled()
+                gc.disable()
+
+                try:
+                    diff['data'][metric], only_a, only_b = diff_values(
+                        values_a, query_b['data'][metric], diff['data_types'][metric]
+                    )
+                finally:
+                    if enabled:
+                        gc.enable()
+
+                # Metrics normally share their labels, so each is listed once
+                for report, labels in [('a', only_a), ('b', only_b)]:
+                    if labels:
+                        listed = set(diff['unmatched'][report])
+                        diff['unmatched'][report].extend(label for label in labels if label not in listed)
+
+            yield diff
+
+        unmatched['b'].extend(config for i, config in enumerate(configs_b) if i not in matched)
+
+    def series(self, reports, window=4):
+        """
+        Generate a time series from several data reports, oldest first.
+
+        Queries are matched to those of the first report. The series' queries
+        are generated lazily; its lists of unmatched queries are complete
+        once they have been consumed.
+        """
+        arguments = ['title'] + GLOBAL_ARGUMENTS + ['run_date']
+
+        output = OrderedDict([
+            ('reports', [OrderedDict([(arg, report.get(arg)) for arg in arguments]) for report in reports]),
+            ('periods', [self._period(report) for report in reports]),
+            ('window', window),
+            ('queries', None),
+            ('unmatched', [[] for report in reports])
+        ])
 
-                    diff['config'] = query_a['config']
-                    diff['data_types'] = query_a['data_types']
-                    diff['data'] = OrderedDict()
+        output['queries'] = self._series_queries(reports, window, output['unmatched'])
 
-                    for metric, values in query_a['data'].items():
-                        data_type = diff['data_types'][metric]
-                        diff['data'][metric] = OrderedDict()
+        return output
 
-                        total_a = values['total']
-                        total_b = query_b['data'][metric]['total']
+    def _period(self, report):
+        """
+        Name the period a report covers by its end date, or the date it was
+        run if its end date is relative.
+        """
+        end_date = report.get('end-date')
+
+        if end_date and re.match(r'^\d{4}-\d{2}-\d{2}$', end_date):
+            return end_date
+
+        return report['run_date']
+
+    def _series_queries(self, reports, window, unmatched):
+        """
+        Yield a time series for each query in the first report.
+        """
+        # Index every later report once, as for a diff
+        indexes = []
+        configs = []
+
+        for report in reports[1:]:
+            index = defaultdict(deque)
+            report_configs = []
+
+            for i, query in enumerate(report['queries']):
+                index[config_hash(query['config'])].append(i)
+                report_configs.append(query['config'])
+
+            indexes.append(index)
+            configs.append(report_configs)
+
+        matched = [set() for report in reports[1:]]
+
+        for query in reports[0]['queries']:
+            key = config_hash(query['config'])
+            queries = [query]
+
+            for report, index, used in izip(reports[1:], indexes, matched):
+                if index[key]:
+                    i = index[key].popleft()
+                    used.add(i)
+                    queries.append(report['queries'][i])
+                else:
+                    queries.append(None)
+
+            yield self._series_query(queries, window)
+
+        for i, (report_configs, used) in enumerate(izip(configs, matched)):
+            unmatched[i + 1].extend(config for j, config in enumerate(report_configs) if j not in used)
+
+    def _series_query(self, queries, window):
+        """
+        Compute the time series of one query, given its data from every report
+        (or None where a report lacks it).
+        """
+        first = queries[0]
 
-                        for label, value in values.items():
-                            a = value
-                            
-                            try:
-                                b = query_b['data'][metric][label]
-                            # TODO: hack for when labels are different...
-                            except KeyError:
-                                continue
+        series = OrderedDict()
 
-                            change = b - a
-                            percent_change = float(change) / a if a > 0 else None
-                            
-                            percent_a = float(a) / total_a if total_a > 0 else None
-                            percent_b = float(b) / total_b if total_b > 0 else None
+        series['config'] = first['config']
+        series['data_types'] = first['data_types']
+        series['data'] = OrderedDict()
 
-                            if label == 'total' or data_type == 'TIME' or percent_a is None or percent_b is None:
-                                point_change = None
-                            else:
-                                point_change = percent_b - percent_a
+        # Every metric in a query shares the same labels, so align them once
+        first_metric = first['data'].keys()[0]
+        labels = align_series_labels([query['data'].get(first_metric) if query is not None else None for query in queries])
 
-                            diff['data'][metric][label] = OrderedDict([
-                                ('change', change),
-                                ('percent_change', percent_change),
-                                ('point_change', point_change),
-                            ])
+        for metric in first['data']:
+            metrics = [query['data'].get(metric) if query is not None else None for query in queries]
 
-                    output['queries'].append(diff)
+            # One column per report, with a value for every label
+            columns = [
+                [values.get(label) for label in labels] if values is not None else [None] * len(labels)
+                for values in metrics
+            ]
 
-            query_b = report_b['queries']
+            changes, percent_changes, rolling_means = compute_series(columns, window)
 
-        return output 
+            series['data'][metric] = OrderedDict(
+                (label, OrderedDict([
+                    ('values', list(values)),
+                    ('changes', list(change)),
+                    ('percent_changes', list(percent_change)),
+                    ('rolling_means', list(rolling_mean))
+                ] + _summarize(values)))
+                for label, values, change, percent_change, rolling_mean in izip(
+                    labels, izip(*columns), izip(*changes), izip(*percent_changes), izip(*rolling_means)
+                )
+            )
+
+        return series
 
     def txt(self, diff, f):
         """
         Generate a text report for a diff.
         """
-        env = Environment(
-            loader=PackageLoader('clan', 'templates'),
-            trim_blocks=True,
-            lstrip_blocks=True
-        )
+        env = get_environment(trim_blocks=True, lstrip_blocks=True)
 
         template = env.get_template('diff.txt')
 
@@ -177,27 +473,16 @@ class DiffCommand(object):
             'format_row': format_row
         }
 
-        f.write(template.render(**context).encode('utf-8'))
+        render_to_file(template, context, f)
 
     def html(self, diff, f):
         """
         Generate a text report for a diff.
         """
-        env = Environment(loader=PackageLoader('clan', 'templates'))
+        env = get_environment()
 
         template = env.get_template('diff.html')
 
-        def number_class(v):
-            if v is None:
-                return ''
-
-            if v > 0:
-                return 'positive'
-            elif v < 0:
-                return 'negative'
-
-            return ''
-
         context = {
             'diff': diff,
             'GLOBAL_ARGUMENTS': GLOBAL_ARGUMENTS,
@@ -207,5 +492,25 @@ class DiffCommand(object):
 
         }
 
-        f.write(template.render(**context).encode('utf-8'))
+        render_to_file(template, context, f)
+
+    def series_html(self, series, f):
+        """
+        Generate an HTML report for a time series.
+        """
+        env = get_environment()
+
+        template = env.get_template('series.html')
+
+        context = {
+            'series': series,
+            'GLOBAL_ARGUMENTS': GLOBAL_ARGUMENTS,
+            'field_definitions': self.field_definitions,
+            'format_comma': format_comma,
+            'format_duration': format_duration,
+            'number_class': number_class,
+            'sparkline': sparkline
+        }
+
+        render_to_file(template, context, f)
 
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict, defaultdict, deque
+import json
+import os
+import threading
+
+from clan.labels import decode_labels, encode_labels
+from clan.utils import config_hash
+
+class Journal(object):
+    """
+    Append-only record of the queries a report run has completed, so that an
+    interrupted run can be resumed without querying them again.
+
+    The first line of the file is a JSON header describing the report. Each
+    following line holds one completed query and the hash of its
+    configuration. A line cut short by a crash is ignored.
+    """
+    def __init__(self, path, header, resume=False):
+        self.path = path
+        self.header = json.dumps(header, sort_keys=True)
+        self.lock = threading.Lock()
+        self.completed = defaultdict(deque)
+
+        if resume and self._load():
+            self.f = open(path, 'a')
+        else:
+            self.f = open(path, 'w')
+            self.f.write(self.header + '\n')
+            self.f.flush()
+
+    def _load(self):
+        """
+        Read the queries completed by an earlier run. Returns False if there is
+        no journal or it belongs to a differently configured report.
+        """
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            lines = f.readlines()
+
+        if not lines or json.dumps(json.loads(lines[0]), sort_keys=True) != self.header:
+            print 'Ignoring journal for a different report: %s' % self.path
+
+            return False
+
+        for line in lines[1:]:
+            # A crash may leave the last line incomplete
+            if not line.endswith('\n'):
+                break
+
+            entry = json.loads(line, object_pairs_hook=OrderedDict)
+            self.completed[entry['hash']].append(decode_labels(entry['query']))
+
+        # Drop the incomplete line, if there is one, before appending after it
+        with open(self.path, 'r+') as f:
+            f.truncate(sum(len(line) for line in lines if line.endswith('\n')))
+
+        return True
+
+    def __len__(self):
+        return sum(len(queries) for queries in self.completed.values())
+
+    def pop(self, config):
+        """
+        Take the completed query for a configuration, or None if there isn't one.
+        Identical configurations are matched in order.
+        """
+        queries = self.completed.get(config_hash(config))
+
+        if not queries:
+            return None
+
+        return queries.popleft()
+
+    def append(self, query):
+        """
+        Record a completed query.
+        """
+        line = json.dumps(OrderedDict([('hash', config_hash(query['config'])), ('query', encode_labels(query))]))
+
+        with self.lock:
+            self.f.write(line + '\n')
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def remove(self):
+        """
+        Delete the journal once the report has been written.
+        """
+        os.remove(self.path)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+
+class Label(tuple):
+    """
+    The dimension values of one row of results. Labels compare and hash as
+    tuples, so values containing commas can't collide, but display as the
+    values joined with commas.
+    """
+    __slots__ = ()
+
+    def __unicode__(self):
+        return u','.join(self)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+def encode_label(label):
+    """
+    Encode a label as a string, for formats whose keys must be strings. Values
+    are joined with commas, and commas and backslashes within them escaped.
+    The 'total' label is left as it is.
+    """
+    if not isinstance(label, Label):
+        return label
+
+    s = u','.join(label)
+
+    # Most labels have nothing to escape
+    if s.count(',') == len(label) - 1 and '\\' not in s:
+        return s
+
+    return u','.join(value.replace('\\', '\\\\').replace(',', '\\,') for value in label)
+
+def _split(s):
+    """
+    Split an encoded label into its values.
+    """
+    if '\\' not in s:
+        return s.split(',')
+
+    values = []
+    value = []
+    escaped = False
+
+    for c in s:
+        if escaped:
+            value.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == ',':
+            values.append(u''.join(value))
+            value = []
+        else:
+            value.append(c)
+
+    values.append(u''.join(value))
+
+    return values
+
+class LabelPool(object):
+    """
+    Interns the dimension values of a query's labels, so values repeated
+    across rows share one string. Labels are also decoded only once each, so
+    every metric shares the same ones.
+    """
+    def __init__(self):
+        self.values = {}
+        self.decoded = {}
+
+    def label(self, values):
+        # Rows are unique, so a lone value is never repeated
+        if len(values) == 1:
+            return Label(values)
+
+        return Label([self.values.setdefault(value, value) for value in values])
+
+    def decode(self, s):
+        """
+        Decode a label encoded by :func:`encode_label`.
+        """
+        label = self.decoded.get(s)
+
+        if label is None:
+            label = self.decoded[s] = s if s == 'total' else self.label(_split(s))
+
+        return label
+
+def decode_label(s):
+    """
+    Decode a single label encoded by :func:`encode_label`.
+    """
+    return LabelPool().decode(s)
+
+def encode_labels(query):
+    """
+    Copy a query, or a query's diff, with its labels encoded as strings so it
+    can be written as JSON.
+    """
+    if 'data' not in query:
+        return query
+
+    encoded = OrderedDict(query)
+    encoded['data'] = OrderedDict(
+        (metric, OrderedDict((encode_label(label), value) for label, value in values.iteritems()))
+        for metric, values in query['data'].iteritems()
+    )
+
+    if 'unmatched' in query:
+        encoded['unmatched'] = OrderedDict(
+            (report, [encode_label(label) for label in values])
+            for report, values in query['unmatched'].iteritems()
+        )
+
+    return encoded
+
+def decode_labels(query):
+    """
+    Decode the labels of a query, or a query's diff, read from JSON in place.
+    """
+    if 'data' not in query:
+        return query
+
+    pool = LabelPool()
+
+    for metric, values in query['data'].items():
+        query['data'][metric] = OrderedDict((pool.decode(label), value) for label, value in values.iteritems())
+
+    for report, values in query.get('unmatched', {}).items():
+        query['unmatched'][report] = [pool.decode(label) for label in values]
+
+    return query
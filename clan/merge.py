@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+from datetime import timedelta
+import math
+from operator import itemgetter
+import re
+
+# Metrics whose values for separate date ranges can't simply be added up,
+# because the same user or page may be counted in more than one range
+NON_ADDITIVE_METRICS = set([
+    'ga:users',
+    'ga:1dayUsers',
+    'ga:7dayUsers',
+    'ga:14dayUsers',
+    'ga:28dayUsers',
+    'ga:30dayUsers',
+    'ga:sessionsPerUser',
+    'ga:avgTimeOnPage',
+    'ga:uniqueDimensionCombinations',
+    'ga:cohortActiveUsers',
+    'ga:cohortTotalUsers',
+    'ga:cohortTotalUsersWithLifetimeCriteria'
+])
+
+# Ratios that can be recomputed from additive metrics: (numerator, denominator, scale)
+DERIVED_METRICS = {
+    'ga:avgSessionDuration': ('ga:sessionDuration', 'ga:sessions', 1),
+    'ga:pageviewsPerSession': ('ga:pageviews', 'ga:sessions', 1),
+    'ga:bounceRate': ('ga:bounces', 'ga:sessions', 100),
+    'ga:percentNewSessions': ('ga:newUsers', 'ga:sessions', 100),
+    'ga:exitRate': ('ga:exits', 'ga:pageviews', 100),
+    'ga:entranceRate': ('ga:entrances', 'ga:pageviews', 100),
+    'ga:avgPageLoadTime': ('ga:pageLoadTime', 'ga:pageLoadSample', 0.001),
+    'ga:avgServerResponseTime': ('ga:serverResponseTime', 'ga:speedMetricsSample', 0.001),
+    'ga:avgEventValue': ('ga:eventValue', 'ga:totalEvents', 1),
+    'ga:eventsPerSessionWithEvent': ('ga:totalEvents', 'ga:sessionsWithEvent', 1),
+    'ga:transactionsPerSession': ('ga:transactions', 'ga:sessions', 100),
+    'ga:revenuePerTransaction': ('ga:transactionRevenue', 'ga:transactions', 1),
+    'ga:goalConversionRateAll': ('ga:goalCompletionsAll', 'ga:sessions', 100)
+}
+
+# Averages, rates and ratios that aren't listed above, such as
+# ga:avgSearchDuration, ga:revenuePerUser, ga:CPC or ga:ROAS, and calculated
+# metrics, which may be any of those
+RATIO_PATTERN = re.compile(r'avg|Per[A-Z]|Rate|Ratio|^ga:(CPC|CPM|RPC|CTR|ROAS|margin)$|^ga:calcMetric_')
+
+# Durations and amounts of money that are sums. Other TIME and CURRENCY
+# metrics may be averages, such as ga:pageValue, so they aren't summed.
+ADDITIVE_METRICS = set([
+    'ga:sessionDuration',
+    'ga:timeOnPage',
+    'ga:timeOnScreen',
+    'ga:searchDuration',
+    'ga:pageLoadTime',
+    'ga:domainLookupTime',
+    'ga:pageDownloadTime',
+    'ga:redirectionTime',
+    'ga:serverConnectionTime',
+    'ga:serverResponseTime',
+    'ga:domInteractiveTime',
+    'ga:domContentLoadedTime',
+    'ga:userTimingValue',
+    'ga:goalValueAll',
+    'ga:transactionRevenue',
+    'ga:transactionShipping',
+    'ga:transactionTax',
+    'ga:totalValue',
+    'ga:itemRevenue',
+    'ga:refundAmount',
+    'ga:productRefundAmount',
+    'ga:localTransactionRevenue',
+    'ga:localTransactionShipping',
+    'ga:localTransactionTax',
+    'ga:localItemRevenue',
+    'ga:localRefundAmount',
+    'ga:localProductRefundAmount',
+    'ga:adCost',
+    'ga:adsenseRevenue',
+    'ga:adxRevenue',
+    'ga:backfillRevenue',
+    'ga:dfpRevenue',
+    'ga:dcmCost',
+    'ga:dcmFloodlightRevenue'
+])
+
+# Per-goal values and custom metrics, which are always sums
+ADDITIVE_PATTERN = re.compile(r'^ga:(goal\d+Value|metric\d+)$')
+
+# Data types of metrics that are counts, unless listed above
+ADDITIVE_DATA_TYPES = ['INTEGER']
+
+# Data types of the metrics in ADDITIVE_METRICS
+SUMMED_DATA_TYPES = ['INTEGER', 'TIME', 'CURRENCY']
+
+def is_additive(metric, data_type):
+    """
+    True if a metric's values for separate date ranges add up to its value
+    for the combined range. Counts are, unless they count people or are
+    ratios. Durations and amounts of money are only if they are known to
+    be sums.
+    """
+    if metric in NON_ADDITIVE_METRICS or metric in DERIVED_METRICS or RATIO_PATTERN.search(metric):
+        return False
+
+    if metric in ADDITIVE_METRICS or ADDITIVE_PATTERN.match(metric):
+        return data_type in SUMMED_DATA_TYPES
+
+    return data_type in ADDITIVE_DATA_TYPES
+
+def component_metrics(metrics):
+    """
+    List the metrics needed to recompute any derived metrics that are not
+    already among ``metrics``.
+    """
+    components = []
+
+    for metric in metrics:
+        for component in DERIVED_METRICS.get(metric, ())[:2]:
+            if component not in metrics and component not in components:
+                components.append(component)
+
+    return components
+
+def split_range(start_date, end_date, n):
+    """
+    Split a date range into at most ``n`` contiguous ranges of nearly equal
+    length. Returns a list of (start_date, end_date) pairs.
+    """
+    days = (end_date - start_date).days + 1
+    n = max(1, min(n, days))
+
+    return [
+        (start_date + timedelta(days=i * days / n), start_date + timedelta(days=(i + 1) * days / n - 1))
+        for i in range(n)
+    ]
+
+def shard_count(response):
+    """
+    Estimate how many shorter date ranges a sampled query must be split into
+    to get unsampled results. Google samples when a query would read more
+    sessions than its sample size, so each range should cover about that many.
+    """
+    size = float(response.get('sampleSize') or 0)
+    space = float(response.get('sampleSpace') or 0)
+
+    if not size:
+        return 2
+
+    return max(2, int(math.ceil(space / size)))
+
+def _ratio(numerator, denominator, scale):
+    if not denominator:
+        return 0.0
+
+    return float(numerator) / denominator * scale
+
+def merge_responses(responses, dimensions_len):
+    """
+    Combine responses to the same query for separate date ranges into a
+    single response. Additive metrics are summed and derived metrics are
+    recomputed from their components, if those were also queried. Other
+    metrics can't be merged, and are returned as a list alongside the merged
+    response, with their values left as zero.
+    """
+    headers = responses[0]['columnHeaders']
+    names = [column['name'] for column in headers[dimensions_len:]]
+    data_types = [column['dataType'] for column in headers[dimensions_len:]]
+    additive = [is_additive(name, data_type) for name, data_type in zip(names, data_types)]
+    casts = [int if data_type == 'INTEGER' else float for data_type in data_types]
+
+    rows = OrderedDict()
+    totals = [0] * len(names)
+
+    for response in responses:
+        for row in response.get('rows') or []:
+            key = tuple(row[:dimensions_len])
+            values = rows.get(key)
+
+            if values is None:
+                values = rows[key] = [0] * len(names)
+
+            for i, value in enumerate(row[dimensions_len:]):
+                if additive[i]:
+                    values[i] += casts[i](value)
+
+        for i, name in enumerate(names):
+            if additive[i]:
+                totals[i] += casts[i](response['totalsForAllResults'][name])
+
+    position = dict((name, i) for i, name in enumerate(names))
+    unmerged = []
+
+    for i, name in enumerate(names):
+        if additive[i]:
+            continue
+
+        numerator, denominator, scale = DERIVED_METRICS.get(name, (None, None, None))
+
+        if numerator in position and denominator in position:
+            n = position[numerator]
+            d = position[denominator]
+
+            for values in rows.values() + [totals]:
+                values[i] = _ratio(values[n], values[d], scale)
+        else:
+            unmerged.append(name)
+
+    merged = {
+        'columnHeaders': headers,
+        'rows': [list(key) + values for key, values in rows.items()],
+        'totalResults': len(rows),
+        'totalsForAllResults': dict(zip(names, totals)),
+        'containsSampledData': False
+    }
+
+    sampled = [response for response in responses if response.get('containsSampledData')]
+
+    if sampled:
+        merged['containsSampledData'] = True
+        merged['sampleSize'] = sum(int(response.get('sampleSize', 0)) for response in sampled)
+        merged['sampleSpace'] = sum(int(response.get('sampleSpace', 0)) for response in sampled)
+
+    return merged, unmerged
+
+def sort_rows(rows, headers, dimensions_len, sort):
+    """
+    Sort result rows the way Google Analytics would. Rows are ordered by their
+    dimensions unless a sort is given, such as ``['-ga:pageviews']``.
+    """
+    names = [column['name'] for column in headers]
+
+    if not sort:
+        return sorted(rows, key=lambda row: row[:dimensions_len])
+
+    rows = list(rows)
+
+    # Python's sort is stable, so sorting by each field from last to first sorts by all of them
+    for field in reversed(sort):
+        rows.sort(key=itemgetter(names.index(field.lstrip('-'))), reverse=field.startswith('-'))
+
+    return rows
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+from glob import glob
+import hashlib
+import json
+from multiprocessing import Pool, cpu_count
+import os
+import sys
+import time
+
+from clan.columnar import load_columnar
+from clan.stream import ReportReader
+from clan.templates import TEMPLATES_PATH, TEMPLATE_EXTENSIONS, get_environment
+from clan.utils import FieldDefinitions, atomic_write, load_field_definitions
+
+# Stored in the output directory, records which inputs have been rendered
+MANIFEST_NAME = '.clan_render.json'
+
+INPUT_FORMATS = ['.json', '.clan']
+
+TEMPLATES = ['report.html', 'diff.html', 'series.html']
+
+# Rendering state of a worker process, created once by _init_worker
+_renderer = None
+
+class Renderer(object):
+    """
+    Renders reports, diffs and time series using one Jinja environment and
+    one set of field definitions.
+    """
+    def __init__(self):
+        from clan.diff import DiffCommand
+        from clan.report import ReportCommand
+
+        # Definitions were cached by the parent process. Each process needs
+        # its own connection to them.
+        field_definitions = FieldDefinitions()
+
+        self.report_command = ReportCommand()
+        self.report_command.field_definitions = field_definitions
+
+        self.diff_command = DiffCommand()
+        self.diff_command.field_definitions = field_definitions
+
+        env = get_environment()
+
+        for name in TEMPLATES:
+            env.get_template(name)
+
+    def render(self, input_path, output_path):
+        """
+        Render one report, diff or time series to an HTML file.
+        """
+        with open(input_path, 'rb') as f:
+            if os.path.splitext(input_path)[1] == '.clan':
+                data = load_columnar(f)
+            else:
+                data = ReportReader(f).report
+
+            # A failed render leaves neither a partial page nor a temporary file
+            with atomic_write(output_path) as out:
+                if 'a' in data and 'b' in data:
+                    self.diff_command.html(data, out)
+                elif 'periods' in data:
+                    self.diff_command.series_html(data, out)
+                else:
+                    self.report_command.html(data, out)
+
+def _init_worker():
+    """
+    Load templates and field definitions once per worker process.
+    """
+    global _renderer
+
+    _renderer = Renderer()
+
+def _render(job):
+    """
+    Render a job in a worker. Returns (job, manifest entry, error, seconds).
+    """
+    input_path, output_path = job
+    start = time.time()
+
+    try:
+        # Taken before rendering, so changes made meanwhile are seen next time
+        entry = _manifest_entry(input_path)
+        _renderer.render(input_path, output_path)
+    except Exception as e:
+        return job, None, unicode(e) or e.__class__.__name__, time.time() - start
+
+    return job, entry, None, time.time() - start
+
+def _sha1(path, chunk_size=1024 * 1024):
+    """
+    Hash the contents of a file.
+    """
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def _manifest_entry(input_path):
+    """
+    Describe the contents of an input for the manifest.
+    """
+    stat = os.stat(input_path)
+
+    return {
+        'input': input_path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha1': _sha1(input_path)
+    }
+
+def _templates_hash():
+    """
+    Hash the template sources, so pages are re-rendered when clan is upgraded.
+    """
+    digest = hashlib.sha1()
+
+    for name in sorted(os.listdir(TEMPLATES_PATH)):
+        if os.path.splitext(name)[1][1:] in TEMPLATE_EXTENSIONS:
+            with open(os.path.join(TEMPLATES_PATH, name), 'rb') as f:
+                digest.update(name)
+                digest.update(f.read())
+
+    return digest.hexdigest()
+
+class RenderCommand(object):
+    def __init__(self):
+        self.args = None
+        self.manifest = None
+
+    def __call__(self, args):
+        """
+        Render every changed report in a set of inputs to HTML, on a pool of
+        processes.
+        """
+        self.args = args
+
+        input_paths = self._input_paths()
+
+        if not input_paths:
+            raise Exception('No .json or .clan files found.')
+
+        if not os.path.isdir(self.args.output_dir):
+            os.makedirs(self.args.output_dir)
+
+        self.manifest = self._load_manifest()
+        jobs = self._jobs(input_paths)
+
+        skipped = len(input_paths) - len(jobs)
+
+        if not jobs:
+            print 'All %i reports are up to date.' % skipped
+
+            return
+
+        # Fetch field definitions here if they aren't cached yet, rather than
+        # in every worker
+        load_field_definitions()
+
+        try:
+            failures = self._run(jobs)
+        finally:
+            self._write_manifest()
+
+        print 'Rendered %i reports, %i were up to date.' % (len(jobs) - failures, skipped)
+
+        if failures:
+            raise Exception('%i of %i renders failed.' % (failures, len(jobs)))
+
+    def _input_paths(self):
+        """
+        Expand directories and glob patterns into a list of report files.
+        """
+        paths = []
+
+        for path in self.args.input_paths:
+            if os.path.isdir(path):
+                for input_format in INPUT_FORMATS:
+                    paths.extend(glob(os.path.join(path, '*' + input_format)))
+            elif any(c in path for c in '*?['):
+                paths.extend(p for p in glob(path) if os.path.splitext(p)[1] in INPUT_FORMATS)
+            elif os.path.splitext(path)[1] in INPUT_FORMATS:
+                paths.append(path)
+            else:
+                raise Exception('Unsupported input format: %s. Must be .json or .clan.' % os.path.splitext(path)[1])
+
+        return sorted(set(os.path.abspath(path) for path in paths))
+
+    def _load_manifest(self):
+        """
+        Load the record of previous renders, unless rendering everything.
+        """
+        path = os.path.join(self.args.output_dir, MANIFEST_NAME)
+        templates = _templates_hash()
+
+        if not self.args.force and os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+
+            # Pages rendered with other templates are all out of date
+            if manifest.get('templates') == templates:
+                return manifest
+
+        return {'templates': templates, 'outputs': {}}
+
+    def _write_manifest(self):
+        """
+        Write the record of renders atomically.
+        """
+        with atomic_write(os.path.join(self.args.output_dir, MANIFEST_NAME)) as f:
+            json.dump(self.manifest, f, indent=4, sort_keys=True)
+
+    def _jobs(self, input_paths):
+        """
+        Find the inputs whose contents have changed since they were last rendered.
+        """
+        outputs = self.manifest['outputs']
+        jobs = []
+        seen = {}
+
+        for input_path in input_paths:
+            name = os.path.splitext(os.path.basename(input_path))[0] + '.html'
+            output_path = os.path.join(self.args.output_dir, name)
+
+            if name in seen:
+                raise Exception('%s and %s would both be rendered to %s.' % (seen[name], input_path, output_path))
+
+            seen[name] = input_path
+
+            stat = os.stat(input_path)
+            entry = outputs.get(name)
+
+            if entry is not None and entry['input'] == input_path and os.path.exists(output_path):
+                # Unchanged size and modification time means unchanged contents,
+                # so only files that look modified need to be hashed
+                if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    continue
+
+                sha1 = _sha1(input_path)
+
+                if entry['sha1'] == sha1:
+                    entry['mtime'] = stat.st_mtime
+
+                    continue
+
+            jobs.append((input_path, output_path))
+
+        return jobs
+
+    def _run(self, jobs):
+        """
+        Render each job, on a pool of processes if there is more than one.
+        Returns the number of failures.
+        """
+        processes = min(self.args.processes or cpu_count(), len(jobs))
+
+        if processes == 1:
+            _init_worker()
+            results = (_render(job) for job in jobs)
+            pool = None
+        else:
+            pool = Pool(processes, initializer=_init_worker)
+            results = pool.imap_unordered(_render, jobs)
+
+        failures = 0
+
+        try:
+            for (input_path, output_path), entry, error, seconds in results:
+                if error is not None:
+                    failures += 1
+                    sys.stderr.write('Failed to render %s: %s\n' % (input_path, error))
+                else:
+                    self.manifest['outputs'][os.path.basename(output_path)] = entry
+                    print 'Rendered %s (%.1fs)' % (output_path, seconds)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        return failures
+
+    def add_argparser(self, root, parents):
+        """
+        Add arguments for this command.
+        """
+        parser = root.add_parser('render', parents=parents)
+        parser.set_defaults(func=self)
+
+        parser.add_argument(
+            '-p', '--processes',
+            dest='processes', action='store', type=int, default=None,
+            help='Number of reports to render at once. Defaults to the number of CPUs.'
+        )
+
+        parser.add_argument(
+            '-f', '--force',
+            dest='force', action='store_true',
+            help='Render every report, even those that haven\'t changed.'
+        )
+
+        parser.add_argument(
+            'input_paths',
+            action='store', nargs='+',
+            help='JSON or columnar (.clan) reports, diffs or time series to render. May be directories or glob patterns.'
+        )
+
+        parser.add_argument(
+            'output_dir',
+            action='store',
+            help='Directory to write HTML pages to, named after each input.'
+        )
+
+        return parser
@@ -1,29 +1,270 @@
 #!/usr/bin/env python
 
 from collections import OrderedDict
+import copy
 from datetime import date, datetime, timedelta
 import json
+from multiprocessing.pool import ThreadPool
 import os
-from time import sleep
-import yaml
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urlparse
 
-from apiclient import discovery
-import httplib2
-from jinja2 import Environment, PackageLoader
-from oauth2client.file import Storage
+# Imported before any thread calls strptime, which imports it lazily and can
+# fail when two threads do so at once
+import _strptime
 
-from clan.utils import GLOBAL_ARGUMENTS, format_comma, format_duration, format_percent, load_field_definitions
+from clan.aggregate import aggregate
+from clan.cache import ResponseCache
+from clan.columnar import dump_columnar, load_columnar
+from clan.journal import Journal
+from clan.labels import LabelPool
+from clan.merge import DERIVED_METRICS, component_metrics, is_additive, merge_responses, shard_count, sort_rows, split_range
+from clan.stats import NullStats, QueryStats
+from clan.stream import ReportReader, dump_report
+from clan.templates import get_environment, render_to_file
+from clan.throttle import Backoff, CircuitBreaker, RateLimiter
+from clan.utils import GLOBAL_ARGUMENTS, atomic_write, format_comma, format_duration, format_percent, load_field_definitions, resolve_date
+
+MAX_PAGE_SIZE = 10000
+MAX_METRICS = 10
+MAX_DIMENSIONS = 7
+
+DISCOVERY_PATH = os.path.expanduser('~/.clan_discovery.json')
+
+# Google may revise data for this many days after the fact
+DATA_LATENCY_DAYS = 2
+
+# Errors worth retrying: HTTP statuses, and reasons given with a 403
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RETRY_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded', 'backendError', 'internalServerError']
+
+# Errors that only mean requests must slow down, which backoff alone handles
+RATE_LIMIT_STATUSES = [429]
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+# Errors after which no request can succeed until the quota resets
+FATAL_REASONS = ['dailyLimitExceeded']
+
+def _error_reason(error):
+    """
+    Get the reason Google gives for an API error, if any.
+    """
+    try:
+        return json.loads(error.content)['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def _retry_after(error):
+    """
+    Get the number of seconds an API error's Retry-After header asks clients to wait, if any.
+    """
+    try:
+        return float(error.resp['retry-after'])
+    except (KeyError, ValueError):
+        return None
+
+# Python types of the metric data types returned by the API
+DATA_TYPE_CASTS = {
+    'INTEGER': int,
+    'TIME': float,
+    'FLOAT': float,
+    'CURRENCY': float,
+    'PERCENT': float
+}
+
+def _caster(dt):
+    """
+    Get the function that casts metric values of a data type to a Python type.
+    """
+    try:
+        return DATA_TYPE_CASTS[dt]
+    except KeyError:
+        raise Exception('Unknown metric data type: %s' % dt)
+
+def _cast_data_type(d, dt):
+    """
+    Cast a metric value returned by the API to a Python type.
+    """
+    return _caster(dt)(d)
 
 class ReportCommand(object):
     def __init__(self):
         self.args = None
         self.config = None
+        self.field_definitions = None
         self.service = None
+        self.credentials = None
+        self.rate_limiters = []
+        self.backoff = Backoff()
+        self.breaker = CircuitBreaker()
+        self.page_pool = None
+        self.cache = None
+        self.journal = None
+        self.timings = None
+        self.timings_log = None
+        self.timings_lock = threading.Lock()
+        self._local = threading.local()
 
     def __call__(self, args):
         self.args = args
         self.field_definitions = load_field_definitions()
 
+        inputs = [(input_path, self._load_config(input_path)) for input_path in self.args.input_paths]
+
+        # Every property and configuration shares one service, cache and set of rate limits
+        if any(config is not None for input_path, config in inputs):
+            self._connect()
+
+        # Shared by every job, so it must be opened before they are created
+        if self.args.timings_log == '-':
+            self.timings_log = sys.stderr
+        elif self.args.timings_log:
+            self.timings_log = open(self.args.timings_log, 'a')
+
+        jobs = []
+
+        for input_path, config in inputs:
+            jobs.extend(self._jobs(input_path, config))
+
+        if len(self.args.input_paths) > 1 and '{config}' not in self.args.output_path:
+            raise Exception('When reporting on several inputs the output path must include {config}.')
+
+        if len(jobs) > len(self.args.input_paths) and '{property-id}' not in self.args.output_path:
+            raise Exception('When reporting on several properties the output path must include {property-id}.')
+
+        try:
+            self._run_jobs(jobs)
+        finally:
+            if self.timings_log not in (None, sys.stderr):
+                self.timings_log.close()
+
+    def _run_jobs(self, jobs):
+        """
+        Run each report, several at a time if there is more than one.
+        """
+        if len(jobs) == 1:
+            jobs[0].run()
+
+            return
+
+        def run(job):
+            try:
+                job.run()
+            except Exception as e:
+                return job, e
+
+            return job, None
+
+        pool = ThreadPool(self.args.jobs)
+        failures = 0
+
+        try:
+            for job, error in pool.imap_unordered(run, jobs):
+                if error is not None:
+                    failures += 1
+                    sys.stderr.write('Failed to report on %s (%s): %s\n' % (job.args.input_path, getattr(job.args, 'property-id'), error))
+        finally:
+            pool.terminate()
+
+        if failures:
+            raise Exception('%i of %i reports failed.' % (failures, len(jobs)))
+
+    def _load_config(self, input_path):
+        """
+        Load a YAML configuration. Returns None for pre-reported data.
+        """
+        input_format = os.path.splitext(input_path)[1]
+
+        if input_format == '.json' or input_format == '.clan':
+            return None
+        elif input_format == '.yml' or input_format == '.yaml':
+            import yaml
+
+            with open(input_path) as f:
+                return yaml.load(f)
+        else:
+            raise Exception('Unsupported input format: %s. Must be .yml, .json or .clan.' % input_format)
+
+    def _jobs(self, input_path, config):
+        """
+        Create a copy of this command to report on an input for each property
+        it applies to. Copies share the service, cache, rate limiters and HTTP
+        connections of the original.
+        """
+        if config is None:
+            property_ids = [getattr(self.args, 'property-id')]
+        else:
+            property_ids = getattr(self.args, 'property-id') or config.get('property-id', None)
+
+            if not property_ids:
+                raise Exception('You must specify a property-id either in your YAML file or using the --property-id argument.')
+
+            if isinstance(property_ids, basestring):
+                property_ids = property_ids.split(',')
+            elif not isinstance(property_ids, list):
+                property_ids = [property_ids]
+
+            property_ids = [str(property_id).strip() for property_id in property_ids]
+
+        jobs = []
+
+        for property_id in property_ids:
+            job = copy.copy(self)
+            job.args = copy.copy(self.args)
+            job.args.input_path = input_path
+            setattr(job.args, 'property-id', property_id)
+
+            if config is not None:
+                job.config = dict(config)
+                job.config['property-id'] = property_id
+
+            jobs.append(job)
+
+        return jobs
+
+    def run(self):
+        """
+        Report on a single input and write the output.
+        """
+        input_format = os.path.splitext(self.args.input_path)[1]
+
+        if input_format == '.json':
+            with open(self.args.input_path) as f:
+                self.write(ReportReader(f).report)
+        elif input_format == '.clan':
+            with open(self.args.input_path, 'rb') as f:
+                self.write(load_columnar(f))
+        else:
+            report = self.report()
+            header = OrderedDict((arg, report[arg]) for arg in GLOBAL_ARGUMENTS)
+
+            # Dates such as yesterday or 7daysAgo mean a different range each
+            # day, so a journal from another day is for a different report
+            params = self._query_params()
+            header['start-date'] = resolve_date(params['start_date']).isoformat()
+            header['end-date'] = resolve_date(params['end_date']).isoformat()
+
+            self.journal = Journal(self._output_path(report) + '.journal', header, self.args.resume)
+
+            try:
+                self.write(report)
+            finally:
+                self.journal.close()
+
+            # Once the report is written there is nothing left to resume
+            self.journal.remove()
+
+    def _connect(self):
+        """
+        Authorize with Google and prepare to send queries.
+        """
+        from apiclient import discovery
+        from oauth2client.file import Storage
+
         if not self.args.auth:
             home_path = os.path.expanduser('~/.clan_auth.dat')
 
@@ -35,40 +276,94 @@ class ReportCommand(object):
                 raise Exception('Could not locate local authorization token (analytics.dat). Please specify it using --auth or run "clan auth".')
 
         storage = Storage(self.args.auth)
-        credentials = storage.get()
+        self.credentials = storage.get()
 
-        if not credentials or credentials.invalid:
+        if not self.credentials or self.credentials.invalid:
             raise Exception('Invalid authentication. Please run "clan auth" to generate a new token.')
 
-        http = credentials.authorize(http=httplib2.Http())
-        self.service = discovery.build('analytics', 'v3', http=http)
+        self.service = discovery.build_from_document(self._discovery_document(), http=self._http())
 
-        input_format = os.path.splitext(self.args.input_path)[1]
+        if self.args.requests_per_second:
+            self.rate_limiters.append(RateLimiter(self.args.requests_per_second, 1))
 
-        if input_format == '.json':
-            with open(self.args.input_path) as f:
-                report = json.load(f, object_pairs_hook=OrderedDict)
-        elif input_format == '.yml' or input_format == '.yaml':
-            with open(self.args.input_path) as f:
-                self.config = yaml.load(f)
+        if self.args.requests_per_100s:
+            self.rate_limiters.append(RateLimiter(self.args.requests_per_100s, 100))
 
-            if 'property-id' not in self.config:
-                raise Exception('You must specify a property-id either in your YAML file or using the --property-id argument.')
+        if not self.args.no_cache:
+            self.cache = ResponseCache(max_size=self.args.cache_size * 1024 * 1024)
 
-            report = self.report()
-        else:
-            raise Exception('Unsupported input format: %s. Must be .yml or .json.' % input_format)
+    def _discovery_document(self):
+        """
+        Load the Analytics API discovery document, fetching it from Google
+        only if no copy has been saved locally.
+        """
+        if os.path.exists(DISCOVERY_PATH):
+            with open(DISCOVERY_PATH) as f:
+                content = f.read()
+
+            try:
+                json.loads(content)
+
+                return content
+            except ValueError:
+                # A truncated or corrupt copy, fetch it again
+                pass
+
+        import httplib2
+        from apiclient import discovery
+
+        url = discovery.DISCOVERY_URI.format(api='analytics', apiVersion='v3')
+        response, content = httplib2.Http().request(url)
 
-        output_format = os.path.splitext(self.args.output_path)[1]
+        if response.status != 200:
+            raise Exception('Failed to fetch the Google Analytics API discovery document!')
 
+        # Write atomically so a concurrent run never reads a partial copy.
+        # Each run writes its own temporary file, in the same directory so
+        # it can be renamed into place.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(DISCOVERY_PATH), prefix='.clan_discovery.', suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+
+            os.rename(tmp_path, DISCOVERY_PATH)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        return content
+
+    def write(self, report):
+        """
+        Write a report to the output path in the format given by its extension.
+        """
+        output_path = self._output_path(report)
+        output_format = os.path.splitext(output_path)[1]
+
+        # Queries run as the report is written, so it is written beside the
+        # previous report and only replaces it once every query has succeeded
         if output_format == '.html':
-            with open(self.args.output_path, 'w') as f:
+            with atomic_write(output_path) as f:
                 self.html(report, f)
         elif output_format == '.json':
-            with open(self.args.output_path, 'w') as f:
-                json.dump(report, f, indent=4)
+            with atomic_write(output_path) as f:
+                dump_report(report, f)
+        elif output_format == '.clan':
+            with atomic_write(output_path, 'wb') as f:
+                dump_columnar(report, f)
         else:
-            raise Exception('Unsupported output format: %s. Must be .html or .json.' % output_format) 
+            raise Exception('Unsupported output format: %s. Must be .html, .json or .clan.' % output_format) 
+
+    def _output_path(self, report):
+        """
+        Fill in the {property-id} and {config} placeholders of the output path.
+        """
+        config_name = os.path.splitext(os.path.basename(self.args.input_path))[0]
+
+        return self.args.output_path \
+            .replace('{property-id}', str(report.get('property-id'))) \
+            .replace('{config}', config_name)
 
     def add_argparser(self, root, parents):
         """
@@ -92,7 +387,7 @@ class ReportCommand(object):
         parser.add_argument(
             '--property-id',
             dest='property-id', action='store',
-            help='Google Analytics ID of the property to query.'
+            help='Google Analytics ID of the property to query. Separate several IDs with commas to report on each of them.'
         )
 
         parser.add_argument(
@@ -126,15 +421,117 @@ class ReportCommand(object):
         )
 
         parser.add_argument(
-            'input_path',
-            action='store',
-            help='Path to either a YAML configuration file or pre-reported JSON data.'
+            '--paginate',
+            dest='paginate', action='store_true',
+            help='Fetch every page of results for dimensioned queries, rather than only the first.'
+        )
+
+        parser.add_argument(
+            '--unsampled',
+            dest='unsampled', action='store_true',
+            help='Replace sampled results by splitting queries into shorter date ranges and merging their results.'
+        )
+
+        parser.add_argument(
+            '--incremental',
+            dest='incremental', action='store_true',
+            help='Store results for each day and only fetch days that are new or may still be revised.'
+        )
+
+        parser.add_argument(
+            '--refetch-days',
+            dest='refetch_days', action='store', type=int, default=DATA_LATENCY_DAYS,
+            help='Number of recent days to fetch again in incremental mode, because Google may still revise them.'
+        )
+
+        parser.add_argument(
+            '--threads',
+            dest='threads', action='store', type=int, default=4,
+            help='Number of queries to execute concurrently.'
+        )
+
+        parser.add_argument(
+            '--jobs',
+            dest='jobs', action='store', type=int, default=4,
+            help='Number of properties or configurations to report on concurrently.'
+        )
+
+        parser.add_argument(
+            '--requests-per-second',
+            dest='requests_per_second', action='store', type=float, default=10,
+            help='Maximum number of API requests per second. Use 0 for no limit.'
+        )
+
+        parser.add_argument(
+            '--requests-per-100s',
+            dest='requests_per_100s', action='store', type=float, default=100,
+            help='Maximum number of API requests per 100 seconds. Use 0 for no limit.'
+        )
+
+        parser.add_argument(
+            '--retries',
+            dest='retries', action='store', type=int, default=5,
+            help='Number of times to retry a request after a rate limit, server or network error.'
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size', action='store', type=int, default=1,
+            help='Number of API requests to send per batched HTTP request. Defaults to 1 (no batching).'
+        )
+
+        parser.add_argument(
+            '--timings',
+            dest='timings', action='store_true',
+            help='Record how long each query took, and the requests it made, in the report data.'
+        )
+
+        parser.add_argument(
+            '--timings-log',
+            dest='timings_log', action='store',
+            help='Append how long each query took, and the requests it made, to a file as JSON lines. Use - for stderr.'
+        )
+
+        parser.add_argument(
+            '--resume',
+            dest='resume', action='store_true',
+            help='Resume an interrupted report, reusing the queries it completed.'
+        )
+
+        parser.add_argument(
+            '--no-cache',
+            dest='no_cache', action='store_true',
+            help='Do not read or write the local response cache.'
+        )
+
+        parser.add_argument(
+            '--refresh',
+            dest='refresh', action='store_true',
+            help='Ignore cached responses, but store fresh ones.'
+        )
+
+        parser.add_argument(
+            '--cache-ttl',
+            dest='cache_ttl', action='store', type=int, default=3600,
+            help='Seconds to cache responses for date ranges that are not yet closed.'
+        )
+
+        parser.add_argument(
+            '--cache-size',
+            dest='cache_size', action='store', type=int, default=100,
+            help='Maximum size of the response cache in megabytes.'
+        )
+
+        parser.add_argument(
+            'input_paths',
+            action='store', nargs='+',
+            help='Paths to YAML configuration files or pre-reported JSON or columnar (.clan) data.'
         )
 
         parser.add_argument(
             'output_path',
             action='store',
-            help='Path to output either an HTML report or a JSON data file.'
+            help='Path to output either an HTML report, a JSON data file or a columnar (.clan) data file. May include {property-id} and {config}.'
         )
 
         return parser
@@ -151,10 +548,71 @@ class ReportCommand(object):
 
         return d.strftime('%Y-%m-%d')
 
-    def query(self, start_date=None, end_date=None, ndays=None, metrics=[], dimensions=[], filters=None, segment=None, sort=[], start_index=1, max_results=10):
+    def _http(self):
+        """
+        Get an authorized Http instance for the current thread. httplib2 is not
+        thread-safe, so each worker gets its own.
+        """
+        http = getattr(self._local, 'http', None)
+
+        if http is None:
+            import httplib2
+
+            http = self.credentials.authorize(http=httplib2.Http())
+            request = http.request
+
+            def counted(*args, **kwargs):
+                response, content = request(*args, **kwargs)
+                self._stats().add(bytes=len(content))
+
+                return response, content
+
+            http.request = counted
+            self._local.http = http
+
+        return http
+
+    def _stats(self):
+        """
+        Get the counters for the query the current thread is working on.
+        """
+        return getattr(self._local, 'stats', None) or NullStats()
+
+    def _on_behalf(self, func):
+        """
+        Wrap a function that will run in another thread, so the work it does
+        is counted against the current thread's query.
+        """
+        stats = getattr(self._local, 'stats', None)
+
+        def wrapper(*args):
+            self._local.stats = stats
+
+            try:
+                return func(*args)
+            finally:
+                self._local.stats = None
+
+        return wrapper
+
+    def _throttle(self):
+        """
+        Block until every rate limiter allows another request.
+        """
+        waited = sum(limiter.acquire() for limiter in self.rate_limiters)
+
+        self._stats().add(throttled=waited)
+
+    def query(self, **kwargs):
         """
         Execute a query.
         """
+        return self._execute(self._query_params(**kwargs))
+
+    def _query_params(self, start_date=None, end_date=None, ndays=None, metrics=[], dimensions=[], filters=None, segment=None, sort=[], start_index=1, max_results=10):
+        """
+        Resolve the API parameters for a query.
+        """
         if start_date:
             start_date = start_date
         elif getattr(self.args, 'start-date'):
@@ -209,18 +667,196 @@ class ReportCommand(object):
             else:
                 filters = prefix_filter
 
-        return self.service.data().ga().get(
-            ids='ga:' + self.config['property-id'],
-            start_date=start_date,
-            end_date=end_date,
-            metrics=','.join(metrics) or None,
-            dimensions=','.join(dimensions) or None,
-            filters=filters,
-            segment=segment,
-            sort=','.join(sort) or None,
-            start_index=str(start_index),
-            max_results=str(max_results)
-        ).execute()
+        params = {
+            'ids': 'ga:' + self.config['property-id'],
+            'start_date': start_date,
+            'end_date': end_date,
+            'metrics': ','.join(metrics) or None,
+            'dimensions': ','.join(dimensions) or None,
+            'filters': filters,
+            'segment': segment,
+            'sort': ','.join(sort) or None,
+            'start_index': str(start_index),
+            'max_results': str(max_results)
+        }
+
+        return params
+
+    def _cache_key(self, params):
+        """
+        Compute the cache key for a set of API parameters.
+        """
+        return self.cache.key(dict(
+            params,
+            start_date=resolve_date(params['start_date']).isoformat(),
+            end_date=resolve_date(params['end_date']).isoformat()
+        ))
+
+    def _cached(self, params):
+        """
+        Fetch a cached response for a set of API parameters, if there is one.
+        """
+        if not self.cache or self.args.refresh:
+            return None
+
+        response = self.cache.get(self._cache_key(params))
+
+        if response is None:
+            self._stats().add(cache_misses=1)
+        else:
+            self._stats().add(cache_hits=1)
+
+        return response
+
+    def _store(self, params, response):
+        """
+        Cache a response for a set of API parameters.
+        """
+        if self.cache:
+            self.cache.set(self._cache_key(params), response, self._cache_ttl(params['end_date']))
+
+    def _execute(self, params, cache=True):
+        """
+        Execute a single API request, using the cache if possible.
+        """
+        response = self._cached(params) if cache else None
+
+        if response is None:
+            response = self._request(self.service.data().ga().get(**params))
+
+            if cache:
+                self._store(params, response)
+
+        self._count_page(response)
+
+        return response
+
+    def _count_page(self, response):
+        self._stats().add(pages=1, rows=len(response.get('rows') or []))
+
+    def _request(self, request, throttle=True):
+        """
+        Execute an API request or batch. Rate limit errors, server errors and
+        network errors are retried with backoff. Repeated server and network
+        errors open the circuit breaker, which pauses every thread. Rate limit
+        errors don't, since concurrent threads hit them together.
+        """
+        from apiclient.errors import HttpError
+
+        attempt = 0
+
+        stats = self._stats()
+
+        while True:
+            stats.add(throttled=self.breaker.wait())
+
+            if throttle:
+                self._throttle()
+
+            stats.add(requests=1)
+            start = time.time()
+
+            try:
+                response = request.execute(http=self._http())
+            except HttpError as e:
+                reason = _error_reason(e)
+
+                if reason in FATAL_REASONS:
+                    self.breaker.trip(e)
+
+                    raise
+
+                if e.resp.status not in RETRY_STATUSES and reason not in RETRY_REASONS:
+                    raise
+
+                error = e
+                retry_after = _retry_after(e)
+                rate_limited = e.resp.status in RATE_LIMIT_STATUSES or reason in RATE_LIMIT_REASONS
+            except socket.error as e:
+                error = e
+                retry_after = None
+                rate_limited = False
+            else:
+                self.breaker.success()
+                stats.add(http=time.time() - start)
+
+                return response
+
+            stats.add(http=time.time() - start)
+
+            if not rate_limited:
+                self.breaker.failure(retry_after)
+
+            if attempt >= self.args.retries:
+                raise error
+
+            delay = self.backoff.delay(attempt, retry_after)
+            attempt += 1
+            stats.add(retries=1)
+
+            print 'Retrying in %.1f seconds (%i of %i): %s' % (delay, attempt, self.args.retries, error)
+
+            time.sleep(delay)
+
+    def _batch_uri(self):
+        """
+        The API's own batch endpoint, as given by its discovery document.
+        Google no longer accepts batches sent to its global endpoint.
+        """
+        root = self.service._rootDesc
+
+        return urlparse.urljoin(root['rootUrl'], root.get('batchPath', 'batch'))
+
+    def _execute_batch(self, batch_params):
+        """
+        Execute several API requests in a single HTTP round trip. Responses are
+        returned in the same order as the parameters.
+        """
+        responses = [self._cached(params) for params in batch_params]
+        pending = [i for i, response in enumerate(responses) if response is None]
+
+        for response in responses:
+            if response is not None:
+                self._count_page(response)
+
+        if len(pending) > 1:
+            from apiclient.http import BatchHttpRequest
+
+            def callback(request_id, response, exception):
+                # Failed items are left empty and retried individually below
+                if exception is None:
+                    responses[int(request_id)] = response
+
+            batch = BatchHttpRequest(callback=callback, batch_uri=self._batch_uri())
+
+            for i in pending:
+                # Each item in a batch counts against quota as a separate request
+                self._throttle()
+                batch.add(self.service.data().ga().get(**batch_params[i]), request_id=str(i))
+
+            # Every item has already been counted against the rate limits
+            self._request(batch, throttle=False)
+
+            for i in pending:
+                if responses[i] is not None:
+                    self._store(batch_params[i], responses[i])
+                    self._count_page(responses[i])
+
+        for i in pending:
+            if responses[i] is None:
+                responses[i] = self._execute(batch_params[i])
+
+        return responses
+
+    def _cache_ttl(self, end_date):
+        """
+        Closed date ranges can't change, so they are cached forever. Anything
+        more recent is only cached briefly.
+        """
+        if resolve_date(end_date) < date.today() - timedelta(days=DATA_LATENCY_DAYS):
+            return None
+
+        return self.args.cache_ttl
 
     def report(self):
         """
@@ -233,69 +869,587 @@ class ReportCommand(object):
 
         output['title'] = getattr(self.args, 'title') or self.config.get('title', 'Untitled Report')
         output['run_date'] = datetime.now().strftime('%Y-%m-%d')
-        output['queries'] = []
+        output['queries'] = self._report_queries()
+
+        # Filled in as queries complete, so it is written after them
+        if self.args.timings:
+            self.timings = output['timings'] = []
+
+        return output
+
+    def _report_queries(self):
+        """
+        Execute every configured query, yielding each one's data in
+        configuration order as soon as it is available.
+        """
+        analytics = self.config.get('queries', [])
+
+        # Queries completed by an interrupted run are taken from its journal
+        if self.journal is not None:
+            resumed = [self.journal.pop(analytic) for analytic in analytics]
+        else:
+            resumed = [None] * len(analytics)
+
+        pending = [analytic for analytic, data in zip(analytics, resumed) if data is None]
+
+        if len(pending) < len(analytics):
+            print 'Resuming with %i of %i queries already complete' % (len(analytics) - len(pending), len(analytics))
+
+        pool = ThreadPool(self.args.threads)
+        self.page_pool = ThreadPool(self.args.threads)
+
+        try:
+            # imap yields results in submission order, regardless of completion order
+            if self.args.batch_size > 1:
+                batches = [pending[i:i + self.args.batch_size] for i in range(0, len(pending), self.args.batch_size)]
+                results = (data for batch in pool.imap(self._journaled(self._report_batch), batches) for data in batch)
+            else:
+                results = pool.imap(self._journaled(lambda analytic: [self._report_query(analytic)]), pending)
+                results = (data for batch in results for data in batch)
+
+            for analytic, data in zip(analytics, resumed):
+                data = data if data is not None else next(results)
+
+                yield data
+
+                # Views are derived locally from the query's rows
+                for view in analytic.get('views', []):
+                    yield aggregate(data, view)
+        finally:
+            pool.terminate()
+            self.page_pool.terminate()
+
+    def _journaled(self, func):
+        """
+        Wrap a function that reports on queries so the results are journaled
+        as soon as they are complete.
+        """
+        def wrapper(*args):
+            results = func(*args)
+
+            if self.journal is not None:
+                for data in results:
+                    self.journal.append(data)
+
+            return results
+
+        return wrapper
+
+    def _paginate(self, analytic):
+        """
+        Determine if all pages of results should be fetched for a query.
+        """
+        if self.args.paginate:
+            return True
+
+        return analytic.get('paginate', self.config.get('paginate', False))
+
+    def _page_size(self, analytic):
+        """
+        Determine the number of rows to request per page for a query.
+        """
+        max_results = analytic.get('max-results', None)
+
+        if self._paginate(analytic):
+            return min(max_results or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+
+        return max_results or 10
+
+    def _unsampled(self, analytic):
+        """
+        Determine if sampled results for a query should be replaced by
+        merging unsampled results for shorter date ranges.
+        """
+        if self.args.unsampled:
+            return True
+
+        return analytic.get('unsampled', self.config.get('unsampled', False))
+
+    def _incremental(self, analytic):
+        """
+        Determine if a query should be assembled from stored results for each
+        day, fetching only the days that are missing.
+        """
+        if self.args.incremental:
+            return True
+
+        return analytic.get('incremental', self.config.get('incremental', False))
+
+    def _page_params(self, analytic, start_index, max_results, metrics=None, start_date=None, end_date=None):
+        """
+        Resolve the API parameters for one page of a configured query.
+        """
+        return self._query_params(
+            start_date=start_date,
+            end_date=end_date,
+            metrics=metrics or analytic['metrics'],
+            dimensions=analytic.get('dimensions', []),
+            filters=analytic.get('filter', None),
+            segment=analytic.get('segment', None),
+            sort=analytic.get('sort', []),
+            start_index=start_index,
+            max_results=max_results
+        )
+
+    def _report_batch(self, analytics):
+        """
+        Execute the first page of several configured queries in a single batch
+        and convert the results.
+        """
+        # Incremental queries are assembled from stored days instead
+        incremental = [self._incremental(analytic) for analytic in analytics]
+
+        # The cost of the batch is shared by the queries in it
+        stats = QueryStats()
+        self._local.stats = stats
+        start = time.time()
+
+        try:
+            responses = iter(self._execute_batch([
+                self._page_params(analytic, analytic.get('start-index', 1), self._page_size(analytic))
+                for analytic, skip in zip(analytics, incremental) if not skip
+            ]))
+        finally:
+            self._local.stats = None
+
+        stats.add(wall=time.time() - start)
+
+        data = []
+
+        for analytic, skip in zip(analytics, incremental):
+            share = stats.share(len(analytics))
+            results = None
+
+            # Pages belong to a single query, so they aren't shared
+            if not skip:
+                results = next(responses)
+                share.set(pages=1, rows=len(results.get('rows') or []))
+            else:
+                share.set(pages=0, rows=0)
+
+            data.append(self._report_query(analytic, results, share))
+
+        return data
+
+    def _report_query(self, analytic, results=None, stats=None):
+        """
+        Execute a single configured query, convert the results and record the
+        work it took. If the first page of results has already been fetched it
+        may be passed in, along with the stats for fetching it.
+        """
+        print 'Querying "%s"' % analytic['name']
+
+        stats = stats or QueryStats()
+        self._local.stats = stats
+        start = time.time()
+
+        try:
+            data = self._query_data(analytic, results)
+        finally:
+            self._local.stats = None
+
+        stats.add(wall=time.time() - start)
+        self._record_timing(analytic, stats)
+
+        return data
+
+    def _record_timing(self, analytic, stats):
+        """
+        Add a query's stats to the report's timings and the timings log, if
+        either was requested.
+        """
+        timing = OrderedDict([
+            ('property-id', self.config['property-id']),
+            ('name', analytic['name'])
+        ])
+
+        timing.update(stats.as_dict())
+
+        with self.timings_lock:
+            if self.timings is not None:
+                self.timings.append(timing)
+
+            if self.timings_log is not None:
+                self.timings_log.write(json.dumps(timing) + '\n')
+                self.timings_log.flush()
+
+    def _query_data(self, analytic, results=None):
+        """
+        Execute a single configured query and convert the results.
+        """
+        dimensions_len = len(analytic.get('dimensions', []))
+        start_index = analytic.get('start-index', 1)
+        max_results = analytic.get('max-results', None)
+        page_size = self._page_size(analytic)
+
+        merged = False
+
+        if results is None and self._incremental(analytic):
+            results = self._incremental_results(analytic)
+            merged = results is not None
 
-        for analytic in self.config.get('queries', []):
-            print 'Querying "%s"' % analytic['name']
+        if results is None:
+            results = self._execute(self._page_params(analytic, start_index, page_size))
 
-            results = self.query(
-                metrics=analytic['metrics'],
-                dimensions=analytic.get('dimensions', []),
+        sampled_results = None
+        unmerged = []
+
+        if not merged and results.get('containsSampledData') and self._unsampled(analytic):
+            sampled_results = results
+            results, shards, unmerged = self._unsampled_results(analytic, results)
+            merged = True
+        
+        data = OrderedDict([ 
+            ('config', analytic),
+            ('sampled', results.get('containsSampledData', False)),
+            ('sampleSize', int(results.get('sampleSize', 0))),
+            ('sampleSpace', int(results.get('sampleSpace', 0))),
+            ('data_types', OrderedDict()),
+            ('data', OrderedDict())
+        ])
+
+        if sampled_results is not None:
+            data['shards'] = shards
+            data['estimated'] = unmerged
+                
+        for column in results['columnHeaders'][dimensions_len:]:
+            data['data_types'][column['name']] = column['dataType']
+
+        for metric in analytic['metrics']:
+            data['data'][metric] = OrderedDict()
+
+        # Every metric shares one label per row
+        labels = LabelPool()
+
+        if dimensions_len:
+            self._ingest_rows(data, dimensions_len, results.get('rows', []), labels)
+
+            # Merged results already include every page
+            if self._paginate(analytic) and not merged:
+                stop = results.get('totalResults', 0) + 1
+
+                if max_results:
+                    stop = min(stop, start_index + max_results)
+
+                # The total is known after the first page, so the rest can be fetched concurrently
+                page_params = [
+                    self._page_params(analytic, page_start, min(page_size, stop - page_start))
+                    for page_start in range(start_index + page_size, stop, page_size)
+                ]
+
+                if self.args.batch_size > 1:
+                    batches = [page_params[i:i + self.args.batch_size] for i in range(0, len(page_params), self.args.batch_size)]
+                    pages = (page for batch in self.page_pool.imap(self._on_behalf(self._execute_batch), batches) for page in batch)
+                else:
+                    pages = self.page_pool.imap(self._on_behalf(self._execute), page_params)
+
+                for page in pages:
+                    self._ingest_rows(data, dimensions_len, page.get('rows', []), labels)
+
+        # Metrics that can't be merged keep their sampled values. Every metric
+        # must share the merged rows' labels, so those the sampled results
+        # lack are left as merged, at zero.
+        if unmerged and dimensions_len:
+            sampled_rows = dict((tuple(row[:dimensions_len]), row) for row in sampled_results.get('rows') or [])
+
+            for metric in unmerged:
+                cast = _caster(data['data_types'][metric])
+                column = dimensions_len + analytic['metrics'].index(metric)
+                values = data['data'][metric]
+
+                for label in values:
+                    row = sampled_rows.get(label)
+
+                    if row is not None:
+                        values[label] = cast(row[column])
+
+        for metric in analytic['metrics']:
+            data['data'][metric]['total'] = _cast_data_type(results['totalsForAllResults'][metric], data['data_types'][metric])
+
+        return data
+
+    def _unsampled_results(self, analytic, sampled_results):
+        """
+        Split a sampled query into shorter date ranges, which Google is less
+        likely to sample, and merge their results. Ranges that are still
+        sampled are split again, down to single days. Returns the merged
+        results, the number of date ranges queried and a list of the metrics
+        that could not be merged.
+        """
+        params = self._page_params(analytic, 1, MAX_PAGE_SIZE)
+        start_date = resolve_date(params['start_date'])
+        end_date = resolve_date(params['end_date'])
+
+        # Derived metrics are recomputed from their components, if the API allows that many metrics
+        metrics = analytic['metrics'] + component_metrics(analytic['metrics'])
+
+        if len(metrics) > MAX_METRICS:
+            metrics = analytic['metrics']
+
+        pending = split_range(start_date, end_date, shard_count(sampled_results))
+        shards = []
+
+        print 'Splitting "%s" into %i date ranges to avoid sampling' % (analytic['name'], len(pending))
+
+        while pending:
+            responses = self.page_pool.map(self._on_behalf(lambda shard: self._query_shard(analytic, metrics, shard)), pending)
+            split = []
+
+            for shard, response in zip(pending, responses):
+                if response.get('containsSampledData') and shard[0] < shard[1]:
+                    split.extend(split_range(shard[0], shard[1], shard_count(response)))
+                else:
+                    shards.append((shard, response))
+
+            pending = split
+
+        shards.sort(key=lambda shard: shard[0])
+        results, unmerged = self._merge(analytic, [response for shard, response in shards])
+
+        for metric in unmerged:
+            results['totalsForAllResults'][metric] = sampled_results['totalsForAllResults'][metric]
+
+        if unmerged and not results['containsSampledData']:
+            results['containsSampledData'] = True
+            results['sampleSize'] = sampled_results.get('sampleSize', 0)
+            results['sampleSpace'] = sampled_results.get('sampleSpace', 0)
+
+        return results, len(shards), unmerged
+
+    def _merge(self, analytic, responses):
+        """
+        Merge the results of a query for separate date ranges, then sort and
+        limit the rows as the API would have. Returns the merged results and a
+        list of the metrics that could not be merged.
+        """
+        dimensions_len = len(analytic.get('dimensions', []))
+        results, unmerged = merge_responses(responses, dimensions_len)
+
+        # Drop the columns that were only needed to recompute derived metrics
+        width = dimensions_len + len(analytic['metrics'])
+        results['columnHeaders'] = results['columnHeaders'][:width]
+
+        rows = sort_rows(results['rows'], results['columnHeaders'], dimensions_len, analytic.get('sort', []))
+        start = analytic.get('start-index', 1) - 1
+
+        if self._paginate(analytic):
+            limit = analytic.get('max-results', None)
+        else:
+            limit = self._page_size(analytic)
+
+        results['rows'] = [row[:width] for row in rows[start:start + limit if limit else None]]
+
+        return results, unmerged
+
+    def _incremental_results(self, analytic):
+        """
+        Assemble the results of a query from stored results for each day in
+        its date range. Only days that haven't been stored, or that are recent
+        enough for Google to still revise, are fetched. Returns None if the
+        query's metrics can't be added up across days.
+        """
+        dimensions = analytic.get('dimensions', [])
+        metrics = analytic['metrics'] + component_metrics(analytic['metrics'])
+
+        if len(metrics) > MAX_METRICS or len(dimensions) >= MAX_DIMENSIONS:
+            print 'Can\'t update "%s" incrementally: too many metrics or dimensions' % analytic['name']
+
+            return None
+
+        # Metrics without field definitions, such as custom metrics, are
+        # checked once the API reports their data types
+        data_types = dict((metric, self._data_type(metric)) for metric in analytic['metrics'])
+        non_additive = [
+            metric for metric in analytic['metrics']
+            if metric not in DERIVED_METRICS and data_types[metric] and not is_additive(metric, data_types[metric])
+        ]
+
+        if non_additive:
+            print 'Can\'t update "%s" incrementally: %s can\'t be added up across days' % (analytic['name'], ', '.join(non_additive))
+
+            return None
+
+        params = self._page_params(analytic, 1, MAX_PAGE_SIZE, metrics)
+        start_date = resolve_date(params['start_date'])
+        end_date = resolve_date(params['end_date'])
+        recent = date.today() - timedelta(days=self.args.refetch_days)
+
+        days = OrderedDict()
+        missing = []
+
+        for i in range((end_date - start_date).days + 1):
+            day = start_date + timedelta(days=i)
+            days[day] = None if day > recent else self._cached(self._day_params(params, day))
+
+            if days[day] is None:
+                missing.append(day)
+
+        # Fetch each run of consecutive missing days with a single query
+        runs = []
+
+        for day in missing:
+            if runs and runs[-1][1] == day - timedelta(days=1):
+                runs[-1][1] = day
+            else:
+                runs.append([day, day])
+
+        if runs:
+            print 'Fetching %i of %i days for "%s"' % (len(missing), len(days), analytic['name'])
+
+        for fetched in self.page_pool.map(self._on_behalf(lambda run: self._query_days(analytic, metrics, run[0], run[1])), runs):
+            for day, response in fetched.items():
+                days[day] = response
+
+                if day <= recent and not response.get('containsSampledData'):
+                    self._store(self._day_params(params, day), response)
+
+        results, unmerged = self._merge(analytic, days.values())
+
+        if unmerged:
+            print 'Can\'t update "%s" incrementally: %s can\'t be added up across days' % (analytic['name'], ', '.join(unmerged))
+
+            return None
+
+        return results
+
+    def _data_type(self, metric):
+        """
+        Look up a metric's data type, or None if it has no field definition,
+        as for custom metrics.
+        """
+        if self.field_definitions is None:
+            return None
+
+        try:
+            return self.field_definitions[metric]['dataType']
+        except KeyError:
+            return None
+
+    def _day_params(self, params, day):
+        """
+        Parameters identifying the stored results of a query for a single day.
+        """
+        return dict(params, start_date=day.isoformat(), end_date=day.isoformat(), partial='day')
+
+    def _query_days(self, analytic, metrics, start_date, end_date):
+        """
+        Fetch the results of a query for each day in a date range, using two
+        queries broken down by date: one for the rows and one for the totals.
+        Returns a dictionary of days and their results.
+        """
+        dimensions = analytic.get('dimensions', [])
+
+        # Break rows down by date, unless they already are
+        add_date = 'ga:date' not in dimensions
+
+        if add_date:
+            date_index = len(dimensions)
+            row_dimensions = dimensions + ['ga:date']
+        else:
+            date_index = dimensions.index('ga:date')
+            row_dimensions = dimensions
+
+        def fetch_all(**kwargs):
+            params = self._query_params(
+                start_date=start_date.isoformat(),
+                end_date=end_date.isoformat(),
+                metrics=metrics,
                 filters=analytic.get('filter', None),
                 segment=analytic.get('segment', None),
-                sort=analytic.get('sort', []),
-                start_index=analytic.get('start-index', 1),
-                max_results=analytic.get('max-results', 10)
+                max_results=MAX_PAGE_SIZE,
+                **kwargs
             )
-            
-            dimensions_len = len(analytic.get('dimensions', []))
-
-            data = OrderedDict([ 
-                ('config', analytic),
-                ('sampled', results.get('containsSampledData', False)),
-                ('sampleSize', int(results.get('sampleSize', 0))),
-                ('sampleSpace', int(results.get('sampleSpace', 0))),
-                ('data_types', OrderedDict()),
-                ('data', OrderedDict())
-            ])
-                    
-            for column in results['columnHeaders'][dimensions_len:]:
-                data['data_types'][column['name']] = column['dataType']
-
-            def cast_data_type(d, dt):
-                if dt == 'INTEGER':
-                    return int(d)
-                elif data_type in ['TIME', 'FLOAT', 'CURRENCY', 'PERCENT']:  
-                    return float(d)
-                else:
-                    raise Exception('Unknown metric data type: %s' % data_type)
 
-            for i, metric in enumerate(analytic['metrics']):
-                data['data'][metric] = OrderedDict()
-                data_type = data['data_types'][metric]
+            # The range changes every day, so these aren't worth caching
+            response = self._execute(params, cache=False)
+            rows = list(response.get('rows') or [])
 
-                if dimensions_len:
-                    for row in results.get('rows', []):
-                        column = i + dimensions_len
-                        label = ','.join(row[:dimensions_len]) 
-                        value = cast_data_type(row[column], data_type)
+            for start_index in range(1 + MAX_PAGE_SIZE, response.get('totalResults', 0) + 1, MAX_PAGE_SIZE):
+                rows.extend(self._execute(dict(params, start_index=str(start_index)), cache=False).get('rows') or [])
 
-                        data['data'][metric][label] = value 
+            return response, rows
 
-                data['data'][metric]['total'] = cast_data_type(results['totalsForAllResults'][metric], data_type)
+        response, rows = fetch_all(dimensions=row_dimensions)
 
-                # Prevent rate-limiting
-                sleep(1)
+        if row_dimensions == ['ga:date']:
+            totals_response, totals_rows = response, rows
+        else:
+            totals_response, totals_rows = fetch_all(dimensions=['ga:date'])
 
-            output['queries'].append(data)
+        headers = list(response['columnHeaders'])
 
-        return output
+        if add_date:
+            del headers[date_index]
+
+        days = OrderedDict()
+
+        for i in range((end_date - start_date).days + 1):
+            day = start_date + timedelta(days=i)
+
+            days[day] = {
+                'columnHeaders': headers,
+                'rows': [],
+                'totalsForAllResults': dict((metric, 0) for metric in metrics),
+                'containsSampledData': response.get('containsSampledData', False) or totals_response.get('containsSampledData', False)
+            }
+
+        for row in totals_rows:
+            day = datetime.strptime(row[0], '%Y%m%d').date()
+            days[day]['totalsForAllResults'] = dict(zip(metrics, row[1:]))
+
+        for row in rows:
+            day = datetime.strptime(row[date_index], '%Y%m%d').date()
+
+            if add_date:
+                row = row[:date_index] + row[date_index + 1:]
+
+            days[day]['rows'].append(row)
+
+        return days
+
+    def _query_shard(self, analytic, metrics, shard):
+        """
+        Fetch every page of results for a query over part of its date range.
+        If the first page is sampled, only it is returned.
+        """
+        start_date, end_date = shard
+        params = self._page_params(analytic, 1, MAX_PAGE_SIZE, metrics, start_date.isoformat(), end_date.isoformat())
+        response = self._execute(params)
+
+        if response.get('containsSampledData') and start_date < end_date:
+            return response
+
+        rows = list(response.get('rows') or [])
+
+        for start_index in range(1 + MAX_PAGE_SIZE, response.get('totalResults', 0) + 1, MAX_PAGE_SIZE):
+            rows.extend(self._execute(dict(params, start_index=str(start_index))).get('rows') or [])
+
+        return dict(response, rows=rows)
+
+    def _ingest_rows(self, data, dimensions_len, rows, labels):
+        """
+        Add a page of result rows to the per-metric data for a query. Labels
+        are interned in a :class:`.LabelPool`.
+
+        Rows are converted in a single pass: each row's label is built once
+        and every metric's value is cast by a function resolved up front.
+        """
+        columns = [
+            (values, _caster(data['data_types'][metric]), dimensions_len + i)
+            for i, (metric, values) in enumerate(data['data'].items())
+        ]
+
+        for row in rows:
+            label = labels.label(row[:dimensions_len])
+
+            for values, cast, column in columns:
+                values[label] = cast(row[column])
 
     def html(self, report, f):
         """
         Write report data to an HTML file.
         """
-        env = Environment(loader=PackageLoader('clan', 'templates'))
+        env = get_environment()
 
         template = env.get_template('report.html')
 
@@ -308,6 +1462,6 @@ class ReportCommand(object):
             'format_percent': format_percent
         }
 
-        f.write(template.render(**context).encode('utf-8'))
+        render_to_file(template, context, f)
 
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+import threading
+
+# Counters kept for each query, in the order they are reported:
+# wall       seconds from starting the query to converting its results
+# http       seconds spent waiting for responses from Google
+# throttled  seconds spent waiting on rate limiters and the circuit breaker
+# bytes      bytes of response bodies received
+# rows       rows of results received
+# pages      pages of results received, from Google or the cache
+# requests   HTTP requests sent, including retries
+# retries    requests that failed and were retried
+# cache_hits, cache_misses
+STATS_FIELDS = ['wall', 'http', 'throttled', 'bytes', 'rows', 'pages', 'requests', 'retries', 'cache_hits', 'cache_misses']
+
+class QueryStats(object):
+    """
+    Thread-safe counters for the work done on behalf of a single query,
+    possibly by several threads.
+    """
+    def __init__(self):
+        self.counts = dict((field, 0) for field in STATS_FIELDS)
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for field, value in counts.items():
+                self.counts[field] += value
+
+    def set(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def share(self, n):
+        """
+        Split these counters evenly between ``n`` queries, such as those sent
+        together in a batch. Returns the share for one of them.
+        """
+        share = QueryStats()
+        share.counts = dict((field, float(value) / n) for field, value in self.counts.items())
+
+        return share
+
+    def as_dict(self):
+        return OrderedDict(
+            (field, round(self.counts[field], 3) if isinstance(self.counts[field], float) else self.counts[field])
+            for field in STATS_FIELDS
+        )
+
+class NullStats(object):
+    """
+    Stand-in for work that isn't done on behalf of any query.
+    """
+    def add(self, **counts):
+        pass
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+from collections import Mapping, OrderedDict
+import json
+from json.encoder import encode_basestring_ascii
+import math
+import re
+
+from clan.labels import LabelPool, encode_label
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DELIMITERS = ' \t\n\r,:]}'
+
+def dump_report(report, f, indent=4):
+    """
+    Write a report or diff as JSON, writing each query as soon as it is
+    available. ``report['queries']`` may be any iterable, including a
+    generator. Labels are encoded as strings. Otherwise the output is
+    identical to ``json.dump(report, f, indent=4)``.
+    """
+    pad = ' ' * indent
+
+    def default(o):
+        # Serialize read-only views, such as those of a columnar report, as objects
+        if isinstance(o, Mapping):
+            return OrderedDict(o.iteritems())
+
+        raise TypeError('%r is not JSON serializable' % o)
+
+    def dumps(value, depth):
+        return json.dumps(value, indent=indent, default=default).replace('\n', '\n' + pad * depth)
+
+    def dumps_object(members, depth):
+        if not members:
+            return '{}'
+
+        separator = ', \n' + pad * (depth + 1)
+
+        return '{\n' + pad * (depth + 1) + separator.join(members) + '\n' + pad * depth + '}'
+
+    def dumps_value(value, depth):
+        # Most values are numbers, which are cheaper to format directly
+        if type(value) in (int, long):
+            return str(value)
+        elif type(value) is float and not (math.isinf(value) or math.isnan(value)):
+            return repr(value)
+
+        return dumps(value, depth)
+
+    def dumps_query(query, depth):
+        # Labels are encoded as they are written, rather than in a copy of the query
+        if 'data' not in query:
+            return dumps(query, depth)
+
+        keys = {}
+        members = []
+
+        def dumps_label(label):
+            key = keys.get(label)
+
+            if key is None:
+                key = keys[label] = encode_basestring_ascii(encode_label(label))
+
+            return key
+
+        for key, value in query.items():
+            if key == 'data':
+                value = dumps_object([
+                    '%s: %s' % (json.dumps(metric), dumps_object([
+                        '%s: %s' % (dumps_label(label), dumps_value(v, depth + 3))
+                        for label, v in values.iteritems()
+                    ], depth + 2))
+                    for metric, values in value.iteritems()
+                ], depth + 1)
+            elif key == 'unmatched':
+                # Labels found in only one of the reports being diffed
+                value = dumps(OrderedDict(
+                    (report, [encode_label(label) for label in values])
+                    for report, values in value.iteritems()
+                ), depth + 1)
+            else:
+                value = dumps(value, depth + 1)
+
+            members.append('%s: %s' % (json.dumps(key), value))
+
+        return dumps_object(members, depth)
+
+    if not report:
+        f.write('{}')
+
+        return
+
+    f.write('{')
+
+    for i, (key, value) in enumerate(report.items()):
+        f.write(', \n' if i else '\n')
+        f.write('%s%s: ' % (pad, json.dumps(key)))
+
+        if key != 'queries':
+            f.write(dumps(value, 1))
+            continue
+
+        empty = True
+
+        for query in value:
+            f.write('[\n' if empty else ', \n')
+            f.write(pad * 2 + dumps_query(query, 2))
+            f.flush()
+
+            empty = False
+
+        f.write('[]' if empty else '\n%s]' % pad)
+
+    f.write('\n}')
+
+class _Pairs(list):
+    """
+    The members of a decoded JSON object, kept as a list until it is known
+    whether its keys are labels.
+    """
+
+def _ordered(value):
+    """
+    Convert decoded members to ordered dictionaries.
+    """
+    if isinstance(value, _Pairs):
+        return OrderedDict((key, _ordered(v)) for key, v in value)
+    elif isinstance(value, list):
+        return [_ordered(v) for v in value]
+
+    return value
+
+def _decode_query(pairs):
+    """
+    Build a query, or a query's diff, from its decoded members. Its labels are
+    decoded as each metric's dictionary is built, as are the labels a diff
+    found in only one report.
+    """
+    labels = LabelPool()
+    query = OrderedDict()
+
+    for key, value in pairs:
+        if key == 'data' and isinstance(value, _Pairs):
+            query[key] = OrderedDict(
+                (metric, OrderedDict((labels.decode(label), _ordered(v)) for label, v in values))
+                for metric, values in value
+            )
+        elif key == 'unmatched' and isinstance(value, _Pairs):
+            query[key] = OrderedDict((report, [labels.decode(label) for label in values]) for report, values in value)
+        else:
+            query[key] = _ordered(value)
+
+    return query
+
+class ReportReader(object):
+    """
+    Incrementally read a report or diff written as JSON.
+
+    Fields that precede the list of queries are parsed immediately and are
+    available as ``report``. ``report['queries']`` is a :class:`QuerySequence`
+    that decodes one query at a time. Fields that follow the queries are
+    added to ``report`` once the queries have been read through.
+    """
+    def __init__(self, f, chunk_size=64 * 1024):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+        self.query_decoder = json.JSONDecoder(object_pairs_hook=_Pairs)
+        self.buffer = ''
+        self.start = 0
+        self.pos = 0
+        self.eof = False
+
+        self.report = OrderedDict()
+        self.queries_offset = None
+
+        self._seek(0)
+        self._expect('{')
+
+        while self._read_field():
+            pass
+
+    def _seek(self, offset):
+        """
+        Reset the buffer to begin at a byte offset in the file.
+        """
+        self.f.seek(offset)
+        self.buffer = ''
+        self.start = offset
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        """
+        Read more of the file into the buffer. Returns False at end of file.
+        """
+        if self.eof:
+            return False
+
+        chunk = self.f.read(size or self.chunk_size)
+
+        if not chunk:
+            self.eof = True
+
+            return False
+
+        # Drop the part of the buffer that has already been consumed
+        self.start += self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character, or '' at end of file.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def _expect(self, c):
+        """
+        Consume an expected character.
+        """
+        if self._peek() != c:
+            raise ValueError('Malformed JSON: expected "%s" at byte %i' % (c, self.start + self.pos))
+
+        self.pos += 1
+
+    def _decode(self, decoder=None):
+        """
+        Decode the next complete JSON value, reading more of the file as needed.
+        """
+        self._peek()
+        size = self.chunk_size
+
+        while True:
+            try:
+                value, end = (decoder or self.decoder).raw_decode(self.buffer, self.pos)
+
+                # A number cut off at the end of the buffer may decode as a
+                # shorter number, so the value must be followed by a delimiter
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in DELIMITERS):
+                    self.pos = end
+
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+
+            # Grow reads geometrically so very large values aren't re-parsed too often
+            self._fill(size)
+            size *= 2
+
+    def _read_field(self):
+        """
+        Read one field of the top-level object. Returns False when it ends or
+        when the list of queries is reached.
+        """
+        c = self._peek()
+
+        if c == '}':
+            self.pos += 1
+
+            return False
+
+        if c == ',':
+            self.pos += 1
+
+        key = self._decode()
+        self._expect(':')
+
+        if key == 'queries':
+            self._expect('[')
+            self.queries_offset = self.start + self.pos
+            self.report['queries'] = QuerySequence(self)
+
+            return False
+
+        self.report[key] = self._decode()
+
+        return True
+
+    def _iter_queries(self):
+        """
+        Yield (offset, query) for each query in the file, then read any
+        remaining fields.
+        """
+        self._seek(self.queries_offset)
+
+        if self._peek() == ']':
+            self.pos += 1
+        else:
+            while True:
+                offset = self.start + self.pos
+                query = _decode_query(self._decode(self.query_decoder))
+                end = self.start + self.pos
+
+                yield offset, query
+
+                # The reader may have been used while the query was consumed,
+                # for instance by counting or indexing the queries
+                if self.start + self.pos != end:
+                    self._seek(end)
+
+                c = self._peek()
+                self.pos += 1
+
+                if c == ']':
+                    break
+                elif c != ',':
+                    raise ValueError('Malformed JSON: expected "," or "]" at byte %i' % (self.start + self.pos - 1))
+
+                self._peek()
+
+        while self._read_field():
+            pass
+
+    def query_at(self, offset):
+        """
+        Decode the query that begins at a byte offset.
+        """
+        self._seek(offset)
+
+        return _decode_query(self._decode(self.query_decoder))
+
+class QuerySequence(object):
+    """
+    Lazily-decoded sequence of the queries in a report file. Iterating decodes
+    one query at a time. Indexing re-reads a single query from disk once its
+    position is known.
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.offsets = None
+
+    def __iter__(self):
+        offsets = []
+
+        for offset, query in self.reader._iter_queries():
+            offsets.append(offset)
+            yield query
+
+        self.offsets = offsets
+
+    def __len__(self):
+        if self.offsets is None:
+            for query in self:
+                pass
+
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        if self.offsets is None:
+            len(self)
+
+        return self.reader.query_at(self.offsets[i])
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+import atexit
+import os
+
+BYTECODE_CACHE_PATH = os.path.expanduser('~/.clan_templates')
+
+TEMPLATES_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Populated at install time by setup.py
+COMPILED_PATH = os.path.join(TEMPLATES_PATH, 'compiled')
+
+TEMPLATE_EXTENSIONS = ['html', 'css', 'txt']
+
+RENDER_BUFFER_SIZE = 256
+
+_environments = {}
+
+# ModuleLoader cleans up after itself with a weakref callback, which fails if
+# it only runs during interpreter teardown
+atexit.register(_environments.clear)
+
+def get_environment(**options):
+    """
+    Get the shared Jinja environment for a set of environment options.
+
+    Environments are created once per process. Templates precompiled at
+    install time are used when available; otherwise compiled templates are
+    kept in a bytecode cache that persists between runs.
+    """
+    key = tuple(sorted(options.items()))
+
+    if key in _environments:
+        return _environments[key]
+
+    from jinja2 import ChoiceLoader, Environment, FileSystemBytecodeCache, ModuleLoader, PackageLoader
+
+    loader = PackageLoader('clan', 'templates')
+
+    # Precompiled templates are only valid with the default options
+    if not options and os.path.isdir(COMPILED_PATH):
+        loader = ChoiceLoader([ModuleLoader(COMPILED_PATH), loader])
+
+    try:
+        if not os.path.isdir(BYTECODE_CACHE_PATH):
+            os.makedirs(BYTECODE_CACHE_PATH)
+
+        bytecode_cache = FileSystemBytecodeCache(BYTECODE_CACHE_PATH)
+    except OSError:
+        bytecode_cache = None
+
+    env = _environments[key] = Environment(loader=loader, bytecode_cache=bytecode_cache, **options)
+
+    return env
+
+def render_to_file(template, context, f, buffer_size=RENDER_BUFFER_SIZE):
+    """
+    Render a template directly to a file. Output is encoded and written as it
+    is generated, ``buffer_size`` template events at a time, so the whole
+    document is never held in memory.
+    """
+    stream = template.stream(**context)
+    stream.enable_buffering(buffer_size)
+    stream.dump(f, encoding='utf-8')
+
+def compile_templates(source, target):
+    """
+    Precompile every template in a directory into Python modules.
+    """
+    from jinja2 import Environment, FileSystemLoader
+
+    env = Environment(loader=FileSystemLoader(source))
+    env.compile_templates(target, extensions=TEMPLATE_EXTENSIONS, zip=None)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import random
+import threading
+import time
+
+class RateLimiter(object):
+    """
+    Thread-safe token bucket. Up to ``rate`` requests are allowed every ``per`` seconds.
+    """
+    def __init__(self, rate, per=1.0):
+        self.rate = float(rate)
+        self.per = float(per)
+        self.tokens = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and consume it. Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+
+                    return waited
+
+                delay = (1 - self.tokens) * self.per / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+class Backoff(object):
+    """
+    Jittered exponential backoff. The delay before each retry is chosen at
+    random, up to a limit that doubles with every attempt, so that threads
+    which failed together don't retry together.
+    """
+    def __init__(self, base=1.0, cap=64.0):
+        self.base = float(base)
+        self.cap = float(cap)
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before retry number ``attempt`` (starting from 0). A
+        delay requested by the server with Retry-After takes precedence.
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+
+        return delay
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker. After ``threshold`` consecutive failures the
+    circuit opens and every request waits ``cooldown`` seconds, or as long as
+    the last failure's Retry-After asked, before it is tried again. A single
+    further failure then reopens it. A fatal error, such as an exhausted
+    daily quota, opens it for good.
+    """
+    def __init__(self, threshold=5, cooldown=60.0):
+        self.threshold = threshold
+        self.cooldown = float(cooldown)
+        self.failures = 0
+        self.opened = None
+        self.open_for = self.cooldown
+        self.error = None
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block while the circuit is open. Raises the fatal error, if there was one.
+        Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                if self.error is not None:
+                    raise self.error
+
+                if self.opened is None:
+                    return waited
+
+                delay = self.opened + self.open_for - time.time()
+
+                if delay <= 0:
+                    # Half-open: let requests through, but reopen on the next failure
+                    self.opened = None
+                    self.failures = self.threshold - 1
+
+                    return waited
+
+            time.sleep(delay)
+            waited += delay
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+
+            if self.failures >= self.threshold and self.opened is None:
+                self.opened = time.time()
+                self.open_for = retry_after if retry_after is not None else self.cooldown
+
+    def trip(self, error):
+        """
+        Open the circuit for good. Every later request raises ``error``.
+        """
+        with self.lock:
+            self.error = error
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 
+import atexit
+import binascii
+from collections import Mapping
+from contextlib import contextmanager
+from datetime import date, timedelta
+import hashlib
 import json
 import os
-
-import requests
+import re
+import sqlite3
+import threading
+import time
 
 GLOBAL_ARGUMENTS = [
     'property-id',
@@ -15,23 +23,132 @@ GLOBAL_ARGUMENTS = [
 ] 
 
 FIELD_DEFINITIONS_URL = 'https://www.googleapis.com/analytics/v3/metadata/ga/columns'
-FIELD_DEFINITIONS_PATH = os.path.expanduser('~/.clan_defs.json')
+FIELD_DEFINITIONS_PATH = os.path.expanduser('~/.clan_defs.db')
+LEGACY_FIELD_DEFINITIONS_PATH = os.path.expanduser('~/.clan_defs.json')
 
-def load_field_definitions():
-    if os.path.exists(FIELD_DEFINITIONS_PATH):
-        with open(FIELD_DEFINITIONS_PATH) as f:
-            fields = json.load(f)
-    else:
-        response = requests.get(FIELD_DEFINITIONS_URL)
+# Seconds before cached field definitions are revalidated with Google
+FIELD_DEFINITIONS_TTL = 7 * 24 * 60 * 60
+
+# Seconds to wait before revalidating again after an attempt
+FIELD_DEFINITIONS_RETRY = 60 * 60
+
+# Seconds to wait for Google to connect and respond when revalidating
+FIELD_DEFINITIONS_TIMEOUT = 5
+
+_field_definitions = None
+
+class FieldDefinitions(Mapping):
+    """
+    Read-only mapping of field ids to their definitions, backed by an indexed
+    SQLite cache. Only the fields that are actually looked up are decoded.
+    """
+    def __init__(self, path=FIELD_DEFINITIONS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.memo = {}
+
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS fields (id TEXT PRIMARY KEY, definition TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def __getitem__(self, field):
+        if field not in self.memo:
+            with self.lock:
+                row = self.db.execute('SELECT definition FROM fields WHERE id = ?', (field,)).fetchone()
+
+            if row is None:
+                raise KeyError(field)
+
+            self.memo[field] = json.loads(row[0])
+
+        return self.memo[field]
+
+    def __iter__(self):
+        with self.lock:
+            ids = [row[0] for row in self.db.execute('SELECT id FROM fields')]
+
+        return iter(ids)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM fields').fetchone()[0]
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def is_stale(self):
+        """
+        True if the definitions are missing or older than FIELD_DEFINITIONS_TTL,
+        and revalidating them hasn't been attempted in the last
+        FIELD_DEFINITIONS_RETRY seconds.
+        """
+        fetched = self.get_meta('fetched')
+        attempted = self.get_meta('attempted')
+
+        if attempted is not None and time.time() - float(attempted) < FIELD_DEFINITIONS_RETRY:
+            return False
+
+        return fetched is None or time.time() - float(fetched) > FIELD_DEFINITIONS_TTL
+
+    def store(self, fields, etag=None, fetched=None):
+        """
+        Replace every cached definition.
+        """
+        if fetched is None:
+            fetched = time.time()
+
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM fields')
+            self.db.executemany(
+                'INSERT INTO fields (id, definition) VALUES (?, ?)',
+                ((field, json.dumps(definition)) for field, definition in fields.items())
+            )
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('etag', etag))
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('fetched', str(fetched)))
+
+        self.memo.clear()
+
+    def touch(self):
+        """
+        Mark the cached definitions as freshly validated.
+        """
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('fetched', str(time.time())))
+
+    def attempt(self):
+        """
+        Record that revalidating the definitions was attempted.
+        """
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('attempted', str(time.time())))
+
+    def revalidate(self, requests=None, timeout=FIELD_DEFINITIONS_TIMEOUT):
+        """
+        Fetch definitions from Google, unless they haven't changed since they were cached.
+        """
+        if requests is None:
+            import requests
+
+        etag = self.get_meta('etag')
+        headers = {'If-None-Match': etag} if etag and len(self) else {}
+
+        response = requests.get(FIELD_DEFINITIONS_URL, headers=headers, timeout=timeout)
+
+        if response.status_code == 304:
+            self.touch()
+
+            return
 
         if not response.status_code == 200:
             raise Exception('Failed to fetch field definitions from Google!')
 
-        data = response.json()
-
         fields = {}
 
-        for item in data['items']:
+        for item in response.json()['items']:
             fields[item['id']] = {
                 'type': item['attributes']['type'],
                 'dataType': item['attributes']['dataType'],
@@ -39,11 +156,120 @@ def load_field_definitions():
                 'description': item['attributes']['description']
             }
 
-        with open(FIELD_DEFINITIONS_PATH, 'w') as f:
-            json.dump(fields, f)
+        self.store(fields, response.headers.get('etag'))
+
+def load_field_definitions():
+    """
+    Load metadata for every Google Analytics field, memoized per process.
+
+    Definitions are only fetched synchronously the first time they are needed.
+    After that, stale definitions are used as-is while they are revalidated in
+    the background. Runs that finish first wait briefly for the revalidation
+    when they exit.
+    """
+    global _field_definitions
+
+    if _field_definitions is not None:
+        return _field_definitions
+
+    fields = FieldDefinitions()
+
+    if not len(fields):
+        if os.path.exists(LEGACY_FIELD_DEFINITIONS_PATH):
+            # Import definitions cached by earlier versions. They have no
+            # timestamp, so they will be revalidated immediately.
+            with open(LEGACY_FIELD_DEFINITIONS_PATH) as f:
+                fields.store(json.load(f), fetched=0)
+        else:
+            fields.revalidate()
+
+    if fields.is_stale():
+        # Imported here so the thread is never still importing when the
+        # interpreter shuts down
+        import requests
+
+        # Recorded up front, so that if this attempt fails or is cut short the
+        # next runs don't immediately try again
+        fields.attempt()
+
+        def revalidate():
+            try:
+                fields.revalidate(requests)
+            except Exception:
+                # Stale definitions are still usable, try again later
+                pass
+
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+        # Short runs wait for the request to finish rather than kill it at exit
+        atexit.register(thread.join, 2 * FIELD_DEFINITIONS_TIMEOUT)
+
+    _field_definitions = fields
 
     return fields
 
+def config_hash(config):
+    """
+    Compute a hash of a query configuration that is the same for configurations
+    Google Analytics treats identically. The order of metrics and of the
+    clauses in an AND filter do not affect results. The order of dimensions and
+    sorts does.
+    """
+    canonical = dict(config)
+
+    if 'metrics' in canonical:
+        canonical['metrics'] = sorted(canonical['metrics'])
+
+    if canonical.get('filter'):
+        canonical['filter'] = ';'.join(sorted(re.split(r'(?<!\\);', canonical['filter'])))
+
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True, default=str)).hexdigest()
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """
+    Open a new file beside ``path`` for writing and rename it over ``path``
+    once it has been written. If writing fails the new file is removed, so
+    ``path`` keeps its previous contents.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, '.%s.%s.tmp' % (name, binascii.hexlify(os.urandom(4))))
+
+    # Created with the same permissions open() would give it
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | (getattr(os, 'O_BINARY', 0) if 'b' in mode else 0)
+    f = os.fdopen(os.open(tmp_path, flags, 0666), mode)
+
+    try:
+        with f:
+            yield f
+
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def resolve_date(d):
+    """
+    Resolve a Google Analytics date expression (YYYY-MM-DD, today, yesterday
+    or NdaysAgo) to a date.
+    """
+    if isinstance(d, date):
+        return d
+
+    if d == 'today':
+        return date.today()
+    elif d == 'yesterday':
+        return date.today() - timedelta(days=1)
+
+    match = re.match(r'^(\d+)daysAgo$', d)
+
+    if match:
+        return date.today() - timedelta(days=int(match.group(1)))
+
+    return date(*map(int, d.split('-')))
+
 def format_comma(d):
     """
     Format a comma separated number.
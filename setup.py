@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import os
 import sys
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 install_requires = [
     'google-api-python-client==1.3.1',
@@ -14,6 +16,24 @@ install_requires = [
 if sys.version_info < (2, 7):
     install_requires.append('argparse>=1.2.1')
 
+class BuildPyCommand(build_py):
+    """
+    Precompile templates into Python modules so they needn't be compiled at runtime.
+    """
+    def run(self):
+        build_py.run(self)
+
+        try:
+            # compile_templates only imports Jinja2 when it is called
+            import jinja2
+            from clan.templates import compile_templates
+        except ImportError:
+            # Jinja2 isn't installed yet, templates will be compiled on first use instead
+            return
+
+        templates = os.path.join(self.build_lib, 'clan', 'templates')
+        compile_templates(templates, os.path.join(templates, 'compiled'))
+
 setup(
     name='clan',
     version='0.2.4',
@@ -45,6 +65,9 @@ setup(
     package_data={
         'clan': ['templates/*']
     },
+    cmdclass={
+        'build_py': BuildPyCommand
+    },
     entry_points={
         'console_scripts': [
             'clan = clan:_main'